@@ -0,0 +1,383 @@
+#!/usr/bin/python
+
+"""
+/*
+ * Copyright (C) 2015   Jeremy Chen jeremy_cz@yahoo.com
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *      http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import shutil
+import platform
+import tracemalloc
+import threading
+import subprocess as sp
+import simplejson as json
+import bc_core as bcc
+
+parser = argparse.ArgumentParser(description='benchmarks for buildCentral')
+parser.add_argument('bench', help='benchmark to run', choices=['cycles', 'plan', 'startup', 'output', 'lookup', 'cache'])
+parser.add_argument('-n', '--packages', help='number of generated packages (startup: 100, cache: 10, others: 10000); output: parallel commands; lookup: changed files', type=int, default=None)
+parser.add_argument('-e', '--edges', help='dependencies per package', type=int, default=4)
+parser.add_argument('-s', '--seed', help='random seed', type=int, default=1)
+parser.add_argument('-b', '--budget', help='fail if a run takes longer (seconds; startup: 0.3, cache: 5.0, others: 1.0)', type=float, default=None)
+parser.add_argument('-a', '--arches', help='number of generated target arches (plan)', type=int, default=1)
+parser.add_argument('-c', '--compare', help='also run the previous implementation (networkx, line by line reading) for comparison', action='store_true')
+
+def generate_graph(nr_packages, nr_edges, seed):
+    # a DAG where every package depends on some packages created before it
+    rand = random.Random(seed)
+    graph = {}
+    for i in range(nr_packages):
+        pkg = 'pkg%05d'%(i)
+        deps = set()
+        if i:
+            for j in range(nr_edges):
+                deps.add('pkg%05d'%(rand.randrange(i)))
+        graph[pkg] = list(deps)
+    return graph
+
+def add_loops(graph, nr_loops, seed):
+    # back edges from a dependency to one of its (indirect) users
+    rand = random.Random(seed)
+    packages = sorted(graph)
+    for i in range(nr_loops):
+        pkg = packages[rand.randrange(len(packages) // 2, len(packages))]
+        dep = pkg
+        for j in range(20):
+            if not graph[dep]:
+                break
+            dep = rand.choice(graph[dep])
+        graph[dep].append(pkg)
+    return graph
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return (time.time() - start, result)
+
+def bench_cycles(args):
+    ok = True
+    graph = generate_graph(args.packages, args.edges, args.seed)
+    duration, loops = timed(bcc.find_dependency_loops, graph)
+    print('%-40s %8.3fs  loops: %d'%('acyclic, %d packages'%(args.packages), duration, len(loops)))
+    ok = ok and duration <= args.budget and not loops
+
+    graph = add_loops(generate_graph(args.packages, args.edges, args.seed), 10, args.seed)
+    duration, loops = timed(bcc.find_dependency_loops, graph)
+    print('%-40s %8.3fs  loops: %d'%('10 back edges, %d packages'%(args.packages), duration, len(loops)))
+    ok = ok and duration <= args.budget and len(loops) > 0
+
+    # a chain deep enough to break any recursive implementation
+    graph = dict(('pkg%05d'%(i), ['pkg%05d'%(i + 1)]) for i in range(args.packages))
+    graph['pkg%05d'%(args.packages)] = ['pkg00000']
+    duration, loops = timed(bcc.find_dependency_loops, graph)
+    print('%-40s %8.3fs  loops: %d'%('one loop over %d packages'%(args.packages + 1), duration, len(loops)))
+    ok = ok and duration <= args.budget and len(loops) == 1
+
+    # every package depends on every other one: a badly edited config
+    packages = ['pkg%02d'%(i) for i in range(14)]
+    graph = dict((pkg, [p for p in packages if p != pkg]) for pkg in packages)
+    duration, loops = timed(bcc.find_dependency_loops, graph)
+    print('%-40s %8.3fs  loops: %d'%('fully connected, %d packages'%(len(packages)), duration, len(loops)))
+    ok = ok and duration <= args.budget and len(loops) == 1
+    if args.compare:
+        import networkx as nx
+        start = time.time()
+        nr_cycles = 0
+        for cycle in nx.simple_cycles(nx.DiGraph(graph)):
+            nr_cycles += 1
+            if time.time() - start > args.budget:
+                break
+        print('%-40s %8.3fs  cycles enumerated: %d (stopped)'%('  nx.simple_cycles', time.time() - start, nr_cycles))
+    return ok
+
+def generate_project(graph, proj_root, arch = 'target', nr_arches = 1):
+    # a project tree with one variant and one group holding everything for
+    # each arch; the first arch is the default one
+    arches = [arch] + ['%s%d'%(arch, i) for i in range(1, nr_arches)]
+    for d in ['external', 'workspace', 'tools', os.path.join('project', 'build')]:
+        os.makedirs(os.path.join(proj_root, d))
+    packages = {}
+    for pkg in graph:
+        packages[pkg] = {'Path' : 'workspace/' + pkg, 'Dependency' : graph[pkg], 'MakeTarget' : 'install'}
+    cfg = {
+        'PROJECT_NAME' : 'bench',
+        'HOST' : 'host',
+        'DEFAULT_TARGET' : arch,
+        'TARGETS' : dict((a, {'DESCRIPTION' : 'generated'}) for a in arches),
+        'PACKAGES' : packages,
+        'GROUPS' : {'all' : {'PACKAGES' : sorted(graph)}},
+        'BUILD_VARIANTS' : dict((a, {'DEFAULT_VARIANT' : 'default',
+                                     'VARIANTS' : {'default' : {'GROUPS' : ['all']}}}) for a in arches)
+    }
+    fd = open(os.path.join(proj_root, 'project', 'build', 'build_central.cfg'), 'w')
+    fd.write(json.dumps(cfg))
+    fd.close()
+    fd = open(os.path.join(proj_root, 'project', 'build', 'buildcentralrc'), 'w')
+    fd.write(json.dumps(dict((a, {'TARGET_ARCH' : 'x86', 'TARGET_OS' : 'LINUX'}) for a in arches)))
+    fd.close()
+
+def bench_plan(args):
+    # what 'mk -a __all__' does before the first package starts building
+    proj_root = tempfile.mkdtemp(prefix = 'bc-bench-')
+    try:
+        generate_project(generate_graph(args.packages, args.edges, args.seed), proj_root, 'target', args.arches)
+        start = time.time()
+        config = bcc.parse_build_config(None, proj_root)
+        load_time = time.time() - start
+        if config['ret'] != 'ok':
+            print(config['ret'])
+            return False
+        # a second load, traced, for the memory held by the config
+        tracemalloc.start()
+        bcc.parse_build_config(None, proj_root)
+        load_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        graph = config['BUILD_VARIANTS']['target']['VARIANTS']['default']['GRAPH']
+        start = time.time()
+        build_list = []
+        bcc.generate_build_order(graph, bcc.build_all_target, build_list)
+        build_list.reverse()
+        order_time = time.time() - start
+        start = time.time()
+        deps = bcc.get_package_dependencies(graph, build_list)
+        deps_time = time.time() - start
+        # half of the packages have been built before
+        rand = random.Random(args.seed)
+        history = dict((pkg, rand.uniform(1, 100)) for pkg in build_list if rand.random() < 0.5)
+        start = time.time()
+        bcc.get_critical_path_priority(build_list, deps, history)
+        priority_time = time.time() - start
+    finally:
+        shutil.rmtree(proj_root, ignore_errors=True)
+
+    print('%-40s %8.3fs  peak memory: %.1fMB'%('load config, %d packages, %d arches'%(args.packages, args.arches),
+                                                 load_time, load_memory / 1048576.0))
+    print('%-40s %8.3fs  packages: %d'%('build order of __all__', order_time, len(build_list)))
+    print('%-40s %8.3fs'%('dependencies for the scheduler', deps_time))
+    print('%-40s %8.3fs'%('critical path priority', priority_time))
+    total = load_time + order_time + deps_time + priority_time
+    print('%-40s %8.3fs'%('total', total))
+    return len(build_list) == args.packages and total <= args.budget
+
+def read_lines(cmd, output, log_fd):
+    # how build output used to be read, for comparison
+    pipe = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.STDOUT)
+    while True:
+        line = pipe.stdout.readline()
+        if not line: break
+        output(line)
+        log_fd.write(line)
+    pipe.wait()
+    return pipe.returncode
+
+def bench_output(args):
+    # verbose build output: every command prints a million lines
+    cmd = ['seq', '1000000']
+    received = [0]
+    def output(data):
+        received[0] += len(data)
+    # run_build_command() echoes the command line first
+    expected = (len(sp.check_output(cmd)) + len(' '.join(cmd)) + 1) * args.packages
+    log_fd = open(os.devnull, 'wb', 1 << 16)
+    ok = True
+    try:
+        runs = [('%d commands, chunked'%(args.packages), bcc.run_build_command, (cmd, None, {}, output, log_fd))]
+        if args.compare:
+            runs.append(('%d commands, line by line'%(args.packages), read_lines, (cmd, output, log_fd)))
+        for name, func, func_args in runs:
+            received[0] = 0
+            threads = [threading.Thread(target = func, args = func_args) for i in range(args.packages)]
+            start = time.time()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            duration = time.time() - start
+            print('%-40s %8.3fs  %.1fMB'%(name, duration, received[0] / 1048576.0))
+            if func == bcc.run_build_command:
+                ok = duration <= args.budget and received[0] == expected
+    finally:
+        log_fd.close()
+    return ok
+
+def find_package_by_prefix(path, config, arch):
+    # how a path used to be mapped to a package, for comparison
+    max_len = 0
+    candidate_pkg = None
+    for pkg in config['PACKAGES'][arch]:
+        pkg_base = os.path.join(config['proj_root'], config['PACKAGES'][arch][pkg]['Path'])
+        if path.find(pkg_base) == 0 and len(pkg_base) > max_len:
+            max_len = len(pkg_base)
+            candidate_pkg = pkg
+    return candidate_pkg
+
+def bench_lookup(args):
+    # files of a big change set mapped to packages nested up to 3 levels deep
+    rand = random.Random(args.seed)
+    packages = {}
+    for i in range(10000):
+        path = 'workspace/group%02d/pkg%05d'%(i % 50, i)
+        if i % 10 == 0:
+            path += '/sub%d'%(i % 3)
+        packages['pkg%05d'%(i)] = {'Path' : path}
+    config = {'proj_root' : '/ws', 'PACKAGES' : {'target' : packages}}
+    names = sorted(packages)
+    files = []
+    for i in range(args.packages):
+        pkg = rand.choice(names)
+        files.append('/ws/%s/src/dir%d/file%d.c'%(packages[pkg]['Path'], rand.randrange(5), i))
+
+    start = time.time()
+    bcc.get_package_path_index(config, 'target')
+    index_time = time.time() - start
+    start = time.time()
+    found = bcc.get_packages_by_files(files, config, 'target')
+    lookup_time = time.time() - start
+    print('%-40s %8.3fs'%('index of %d packages'%(len(packages)), index_time))
+    print('%-40s %8.3fs  packages: %d'%('%d changed files'%(len(files)), lookup_time, len(found)))
+    # '/ws/.../pkg00001' must not own '/ws/.../pkg000010'
+    ok = bcc.get_packages_by_path('/ws/workspace/group01/pkg000010', config, 'target') == []
+    if args.compare:
+        start = time.time()
+        for f in files[:100]:
+            find_package_by_prefix(f, config, 'target')
+        print('%-40s %8.3fs'%('  prefix search, 100 files', time.time() - start))
+    return ok and index_time + lookup_time <= args.budget
+
+startup_check = '''
+import os, sys, runpy
+sys.argv = sys.argv[1:]
+sys.path.insert(0, os.path.dirname(sys.argv[0]))
+try:
+    runpy.run_path(sys.argv[0], run_name = '__main__')
+except SystemExit:
+    pass
+sys.stderr.write(' '.join([m for m in %s if m in sys.modules]))
+'''
+
+def run_startup(cmd, proj_root, env, heavy_modules):
+    build_central = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'build_central.py')
+    start = time.time()
+    proc = sp.Popen([sys.executable, '-c', startup_check%(str(heavy_modules)), build_central] + cmd,
+                    stdout = sp.PIPE, stderr = sp.PIPE, cwd = proj_root, env = env)
+    out, err = proc.communicate()
+    return (time.time() - start, err.decode('utf-8').strip().split('\n')[-1])
+
+def bench_startup(args):
+    # a fresh process for every command; only runs with a warm config cache are budgeted
+    heavy_modules = ['networkx', 'multiprocessing', 'tarfile']
+    proj_root = tempfile.mkdtemp(prefix = 'bc-bench-')
+    env = dict(os.environ)
+    env['BC_CACHE_DIR'] = os.path.join(proj_root, 'cache')
+    env['BC_PROJECT_ROOT'] = proj_root
+    ok = True
+    try:
+        # build_central.py expects the host to be one of the targets
+        generate_project(generate_graph(args.packages, args.edges, args.seed), proj_root, platform.system().lower())
+        duration, imported = run_startup(['-l'], proj_root, env, heavy_modules)
+        print('%-40s %8.3fs'%('mk -l (empty config cache)', duration))
+        for cmd in [['-h'], ['-l'], ['-la', bcc.build_all_target]]:
+            results = [run_startup(cmd, proj_root, env, heavy_modules) for i in range(5)]
+            duration = min([result[0] for result in results])
+            imported = results[-1][1]
+            print('%-40s %8.3fs  %s'%('mk ' + ' '.join(cmd), duration, imported and 'imports: ' + imported or ''))
+            ok = ok and duration <= args.budget
+            if cmd[0] in ['-h', '-l'] and imported:
+                ok = False
+
+        # the same command handed to bc_daemon.py
+        daemon = sp.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bc_daemon.py')],
+                          stdout = sp.PIPE, cwd = proj_root, env = env)
+        try:
+            daemon.stdout.readline()
+            cmd = ['-la', bcc.build_all_target]
+            results = [run_startup(cmd, proj_root, env, heavy_modules) for i in range(5)]
+            print('%-40s %8.3fs'%('mk ' + ' '.join(cmd) + ' (daemon)', min([result[0] for result in results])))
+        finally:
+            daemon.terminate()
+            daemon.wait()
+    finally:
+        shutil.rmtree(proj_root, ignore_errors=True)
+    return ok
+
+def bench_cache(args):
+    # cmake packages installing one header each: built, restored from the
+    # binary cache into an empty output dir, then uninstalled by 'mk -c'
+    proj_root = tempfile.mkdtemp(prefix = 'bc-bench-')
+    env = dict(os.environ)
+    env['BC_CACHE_DIR'] = os.path.join(proj_root, 'cache')
+    env['BC_PROJECT_ROOT'] = proj_root
+    bc_dir = os.path.dirname(os.path.abspath(__file__))
+    output_dir = os.path.join(proj_root, 'output')
+    def mk(cmd):
+        start = time.time()
+        proc = sp.Popen([sys.executable, os.path.join(bc_dir, 'build_central.py'), '--no-daemon'] + cmd,
+                        stdout = sp.PIPE, stderr = sp.STDOUT, cwd = proj_root, env = env)
+        out = proc.communicate()[0].decode('utf-8', 'replace')
+        return (time.time() - start, out)
+    def installed():
+        return [name for root, dirs, names in os.walk(os.path.join(output_dir, 'stage')) for name in names]
+    try:
+        graph = generate_graph(args.packages, args.edges, args.seed)
+        generate_project(graph, proj_root, platform.system().lower())
+        os.symlink(bc_dir, os.path.join(proj_root, 'tools', 'buildCentral'))
+        for pkg in graph:
+            os.makedirs(os.path.join(proj_root, 'workspace', pkg))
+            fd = open(os.path.join(proj_root, 'workspace', pkg, 'CMakeLists.txt'), 'w')
+            fd.write('cmake_minimum_required(VERSION 3.5)\nproject(%s NONE)\ninstall(FILES %s.h DESTINATION include)\n'%(pkg, pkg))
+            fd.close()
+            fd = open(os.path.join(proj_root, 'workspace', pkg, pkg + '.h'), 'w')
+            fd.write('#define %s 1\n'%(pkg.upper()))
+            fd.close()
+        duration, out = mk(['-a', bcc.build_all_target])
+        print('%-40s %8.3fs  installed: %d'%('build %d packages'%(args.packages), duration, len(installed())))
+        ok = len(installed()) == args.packages
+
+        shutil.rmtree(output_dir)
+        duration, out = mk(['-a', bcc.build_all_target])
+        restored = out.count('(restored from cache)')
+        print('%-40s %8.3fs  restored: %d'%('restore into an empty output dir', duration, restored))
+        ok = ok and restored == args.packages and len(installed()) == args.packages and duration <= args.budget
+
+        duration, out = mk(['-c', bcc.build_all_target])
+        print('%-40s %8.3fs  left: %d'%('uninstall restored packages', duration, len(installed())))
+        ok = ok and not installed()
+        if not ok:
+            print(out)
+    finally:
+        shutil.rmtree(proj_root, ignore_errors=True)
+    return ok
+
+args = parser.parse_args()
+if args.packages is None:
+    args.packages = {'startup' : 100, 'output' : 4, 'cache' : 10}.get(args.bench, 10000)
+if args.budget is None:
+    args.budget = {'startup' : 0.3, 'cache' : 5.0}.get(args.bench, 1.0)
+benchmarks = {'cycles' : bench_cycles, 'plan' : bench_plan, 'startup' : bench_startup, 'output' : bench_output,
+              'lookup' : bench_lookup, 'cache' : bench_cache}
+if benchmarks[args.bench](args):
+    print('==== Pass! ====')
+    exit(0)
+else:
+    print('==== Failure! budget: %.3fs ===='%(args.budget))
+    exit(-1)
@@ -16,21 +16,38 @@
  */
 """
 
+# networkx and multiprocessing are imported where they are used so that
+# commands like 'mk -l' and 'mk -h' start quickly
 import simplejson as json
-import networkx as nx
 import os
 from string import Template
 import subprocess as sp
 import shutil
-import tarfile
-import copy
 import platform
-import multiprocessing
 import shlex
+import threading
+import tempfile
+import select
+import hashlib
+import re
+import pickle
+import sys
+import time
 
 build_all_target = '__all__' 
 build_cmd_pipe = None
 build_stop = None
+compiler_cache_stats = {}
+package_logs = {}
+# get_merged_graph(): id of a graph -> (graph, merged graph); the graph is
+# kept so that its id is not reused
+merged_graphs = {}
+# Chrome trace events of this run; 'lane' is the build slot of the thread
+trace_events = []
+trace_lock = threading.Lock()
+trace_local = threading.local()
+trace_origin = time.time()
+worker_protocol_version = 2
 
 cmake_generator = {
         'vs16'      : 'Visual Studio 16 2019',
@@ -46,20 +63,34 @@ cmake_generator = {
         'unix'      : 'Unix Makefiles',
         'emingw'    : 'Eclipse CDT4 - MinGW Makefiles',
         'enmake'    : 'Eclipse CDT4 - NMake Makefiles',
-        'eunix'     : 'Eclipse CDT4 - Unix Makefiles'
+        'eunix'     : 'Eclipse CDT4 - Unix Makefiles',
+        'ninja'     : 'Ninja',
+        'mninja'    : 'Ninja Multi-Config',
+        'eninja'    : 'Eclipse CDT4 - Ninja'
         }
 
-def guess_project_root():
-    signature = set(['external', 'workspace', 'project', 'tools'])
+def is_project_root(path):
+    for name in ['external', 'workspace', 'project', 'tools']:
+        if not os.path.isdir(os.path.join(path, name)):
+            return False
+    return True
+
+def guess_project_root(quiet = False):
     cwd = cur_dir = os.getcwd()
+    # set by the mk wrapper once it has found the root
+    cached_root = os.getenv('BC_PROJECT_ROOT')
+    if cached_root and (cwd == cached_root or cwd.startswith(os.path.join(cached_root, ''))) \
+            and is_project_root(cached_root):
+        return cached_root
     parent_dir = os.path.abspath(os.path.join(cur_dir, os.pardir))
     while (parent_dir != cur_dir):
-        if signature.issubset(set(os.listdir(cur_dir))):
+        if is_project_root(cur_dir):
             break
         cur_dir = parent_dir
         parent_dir = os.path.abspath(os.path.join(cur_dir, os.pardir))
     if os.path.dirname(os.path.realpath(cur_dir)) == cur_dir:
-        print('Cannot fild project root! using curent directory instead.')
+        if not quiet:
+            print('Cannot fild project root! using curent directory instead.')
         cur_dir = cwd
     return cur_dir
 
@@ -106,7 +137,8 @@ def init_private_config(config):
                                    'head_search_path' : [],
                                    'env_var' : {},
                                    'stage_dir' : '',
-                                   'env_source_cmd' : ''
+                                   'env_source_cmd' : '',
+                                   'compiler_launcher' : ''
                                    }
 
 def import_configs(dst, src):
@@ -141,6 +173,8 @@ def import_configs(dst, src):
                 return {'ret' : 'error', 'info' : 'unknown generator %s!'%(generator)}
         elif item == 'ENV_SOURCE_CMD':
             dst['env_source_cmd'] = src_value
+        elif item == 'COMPILER_LAUNCHER':
+            dst['compiler_launcher'] = os.path.expanduser(src_value)
         elif item == 'MACRO_DEF':
             dst['macro_definition'].update(src_value)
         elif item == 'MAKE_VAR':
@@ -170,6 +204,20 @@ def import_configs(dst, src):
 
     return {'ret' : 'ok', 'info' : None}
 
+def copy_private_config(private_config):
+    # import_configs() only updates or extends the containers at the first
+    # level, so copying those is enough
+    cfg = {}
+    for item in private_config:
+        value = private_config[item]
+        if isinstance(value, dict):
+            cfg[item] = dict(value)
+        elif isinstance(value, list):
+            cfg[item] = list(value)
+        else:
+            cfg[item] = value
+    return cfg
+
 def do_import_private_config(config, cfg_file):
     try:
         fd = open(cfg_file)
@@ -203,17 +251,20 @@ def do_import_private_config(config, cfg_file):
 
     return {'ret' : 'ok', 'info' : None}
 
-def import_private_config(config):
-    init_private_config(config)
-    files = [
+def get_private_config_files(proj_root):
+    return [
              # default config
-             os.path.join(config['proj_root'], 'tools', 'buildCentral', 'rules', 'buildcentralrc'),
+             os.path.join(proj_root, 'tools', 'buildCentral', 'rules', 'buildcentralrc'),
              # project specific config
-             os.path.join(config['proj_root'], 'project', 'build', 'buildcentralrc'),
+             os.path.join(proj_root, 'project', 'build', 'buildcentralrc'),
              # private config
              os.path.join(os.path.expanduser('~'), '.buildcentralrc')
             ]
 
+def import_private_config(config):
+    init_private_config(config)
+    files = get_private_config_files(config['proj_root'])
+
     for cfg_file in files:
         ret = do_import_private_config(config, os.path.expanduser(cfg_file))
         if ret['ret'] != 'ok':
@@ -244,17 +295,79 @@ def get_stage_path(config, arch, variant, output_dir = None):
             path = os.path.join(output_dir, 'stage', variant, arch)
     return path
 
-def config_package_path(config, arch, pkg, variant):
+class PackageInfo(dict):
+    # the definition of a package as seen by one arch: values set for the arch
+    # (PACKAGES-PER-ARCH, Path, BuildDir, StageDir) are stored in the dict
+    # itself, everything else is read from the definition shared by all arches
+    __slots__ = ('base',)
+
+    def __init__(self, base):
+        dict.__init__(self)
+        self.base = base
+
+    def __missing__(self, key):
+        return self.base[key]
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self.base
+
+    def __iter__(self):
+        for key in dict.__iter__(self):
+            yield key
+        for key in self.base:
+            if not dict.__contains__(self, key):
+                yield key
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def get(self, key, default = None):
+        if key in self:
+            return self[key]
+        return default
+
+    def copy(self):
+        return dict(self.items())
+
+    def __eq__(self, other):
+        return dict(self.items()) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def __reduce__(self):
+        # pickled as overlay plus base, which the config cache shares
+        return (PackageInfo, (self.base,), None, None, iter(dict.items(self)))
+
+def get_package_paths(config, arch, pkg, variant):
+    # Path, BuildDir and StageDir of a package in a variant; config is not
+    # changed, so other threads may use it at the same time
     src_path = os.path.abspath(os.path.join(config['proj_root'], config['PACKAGES'][arch][pkg]['Path']))
     output_dir = config.get('OUTPUT_DIR', src_path)
     if os.path.isfile(src_path):
-        config['PACKAGES'][arch][pkg]['Path'] = os.path.join(output_dir,
-                                                             config['PACKAGES'][arch][pkg]['Path'])
+        path = os.path.join(output_dir, config['PACKAGES'][arch][pkg]['Path'])
     else:
-        config['PACKAGES'][arch][pkg]['Path'] = src_path
+        path = src_path
+    return {'Path' : path,
+            'BuildDir' : os.path.join(output_dir, 'build', variant, pkg, arch),
+            'StageDir' : get_stage_path(config, arch, variant, output_dir)}
 
-    config['PACKAGES'][arch][pkg]['BuildDir'] = os.path.join(output_dir, 'build', variant, pkg, arch)
-    config['PACKAGES'][arch][pkg]['StageDir'] = get_stage_path(config, arch, variant, output_dir)
+def config_package_path(config, arch, pkg, variant):
+    paths = get_package_paths(config, arch, pkg, variant)
+    for name in ['Path', 'BuildDir', 'StageDir']:
+        config['PACKAGES'][arch][pkg][name] = paths[name]
 
 '''
 def parse_build_order(package_list, graphs):
@@ -275,7 +388,144 @@ def parse_build_order(package_list, graphs):
     return ordered_packages
 '''
 
+def add_graph_edge(graph, pkg, dep_pkg):
+    if not pkg in graph:
+        graph[pkg] = set()
+    if not dep_pkg in graph:
+        graph[dep_pkg] = set()
+    graph[pkg].add(dep_pkg)
+
+def find_strongly_connected_components(graph):
+    # iterative Tarjan: O(V + E) and no recursion limit on deep graphs
+    index = {}
+    low_link = {}
+    on_stack = set()
+    stack = []
+    components = []
+    next_index = 0
+    for root in graph:
+        if root in index:
+            continue
+        index[root] = low_link[root] = next_index
+        next_index += 1
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(graph[root]))]
+        while work:
+            node, neighbors = work[-1]
+            descended = False
+            for neighbor in neighbors:
+                if not neighbor in index:
+                    index[neighbor] = low_link[neighbor] = next_index
+                    next_index += 1
+                    stack.append(neighbor)
+                    on_stack.add(neighbor)
+                    work.append((neighbor, iter(graph[neighbor])))
+                    descended = True
+                    break
+                elif neighbor in on_stack:
+                    low_link[node] = min(low_link[node], index[neighbor])
+            if descended:
+                continue
+            work.pop()
+            if work:
+                parent = work[-1][0]
+                low_link[parent] = min(low_link[parent], low_link[node])
+            if low_link[node] == index[node]:
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack.discard(member)
+                    component.append(member)
+                    if member == node:
+                        break
+                components.append(component)
+    return components
+
+def find_dependency_loops(graph):
+    # one concrete loop for every group of packages depending on each other
+    loops = []
+    for component in find_strongly_connected_components(graph):
+        members = set(component)
+        start = min(component)
+        if len(component) == 1 and not start in graph[start]:
+            continue
+        # walk inside the component until a package repeats
+        path = [start]
+        position = {start : 0}
+        node = start
+        while True:
+            node = min([n for n in graph[node] if n in members])
+            if node in position:
+                loops.append(path[position[node]:])
+                break
+            position[node] = len(path)
+            path.append(node)
+    loops.sort()
+    return loops
+
+def get_config_file(cfg_dir, proj_root):
+    if cfg_dir:
+        return os.path.join(cfg_dir, 'build_central.cfg')
+    return os.path.join(proj_root, 'project', 'build', 'build_central.cfg')
+
+def get_config_cache_key(cfg_file, proj_root):
+    # the resolved config only depends on the config files, the project root,
+    # the host and buildCentral itself
+    h = hashlib.sha1()
+    h.update(('%s\n%s\n%s\n%s\n'%(proj_root, cfg_file, str(platform.uname()[0]), sys.version)).encode('utf-8'))
+    for input_file in [cfg_file, os.path.abspath(__file__)] + get_private_config_files(proj_root):
+        try:
+            fd = open(input_file, 'rb')
+        except IOError:
+            h.update(('%s missing\n'%(input_file)).encode('utf-8'))
+            continue
+        h.update(hashlib.sha1(fd.read()).hexdigest().encode('utf-8'))
+        fd.close()
+    return h.hexdigest()
+
+def get_config_cache_file(cfg_file, proj_root):
+    name = hashlib.sha1(('%s\n%s'%(proj_root, cfg_file)).encode('utf-8')).hexdigest()
+    return os.path.join(get_cache_dir(), 'config', name + '.pickle')
+
+config_memory_cache = {}
 def load_build_config(cfg_dir, proj_root):
+    if not proj_root:
+        proj_root = guess_project_root()
+    cfg_file = get_config_file(cfg_dir, proj_root)
+    key = get_config_cache_key(cfg_file, proj_root)
+    cache_file = get_config_cache_file(cfg_file, proj_root)
+
+    # a daemon keeps the pickled config; every caller gets its own copy
+    if cache_file in config_memory_cache and config_memory_cache[cache_file][0] == key:
+        return pickle.loads(config_memory_cache[cache_file][1])['config']
+    try:
+        fd = open(cache_file, 'rb')
+        data = fd.read()
+        fd.close()
+        cached = pickle.loads(data)
+        if cached['key'] == key:
+            config_memory_cache[cache_file] = (key, data)
+            return cached['config']
+    except Exception:
+        pass
+
+    config = parse_build_config(cfg_dir, proj_root)
+    if config['ret'] == 'ok':
+        try:
+            if not os.path.exists(os.path.dirname(cache_file)):
+                os.makedirs(os.path.dirname(cache_file))
+            data = pickle.dumps({'key' : key, 'config' : config}, pickle.HIGHEST_PROTOCOL)
+            config_memory_cache[cache_file] = (key, data)
+            fd = open(cache_file + '.%d.tmp'%(os.getpid()), 'wb')
+            fd.write(data)
+            fd.close()
+            os.rename(cache_file + '.%d.tmp'%(os.getpid()), cache_file)
+        except (IOError, OSError, pickle.PicklingError):
+            pass
+    return config
+
+def parse_build_config(cfg_dir, proj_root):
     config = {'ret' : 'ok'}
     if not proj_root:
         proj_root = guess_project_root()
@@ -297,10 +547,7 @@ def load_build_config(cfg_dir, proj_root):
         config['ret'] = 'Unknown OS: %s'%(os_name)
         return config
 
-    if cfg_dir:
-        cfg_file = os.path.join(cfg_dir, 'build_central.cfg')
-    else:
-        cfg_file = os.path.join(proj_root, 'project', 'build', 'build_central.cfg')
+    cfg_file = get_config_file(cfg_dir, proj_root)
     try:
         fd = open(cfg_file, 'r')
     except IOError:
@@ -363,13 +610,14 @@ def load_build_config(cfg_dir, proj_root):
                                origin_cfg.get('OUTPUT_DIR', os.path.join(proj_root, 'output'))))
         config['LOG_DIR'] = os.path.join(config['OUTPUT_DIR'], 'log')
 
+        # the package definitions are shared by all arches instead of copied
+        packages = origin_cfg.get('PACKAGES', {})
+        for pkg in packages:
+            if 'Tools' in packages[pkg]:
+                packages[pkg]['Tools'] = set(packages[pkg]['Tools'])
         config['PACKAGES'] = {}
-        if 'PACKAGES'in origin_cfg:
-            for arch in config['TARGET_LIST']:
-                config['PACKAGES'][arch] = copy.deepcopy(origin_cfg['PACKAGES'])
-        else:
-            for arch in config['TARGET_LIST']:
-                config['PACKAGES'][arch] = {}
+        for arch in config['TARGET_LIST']:
+            config['PACKAGES'][arch] = dict((pkg, PackageInfo(packages[pkg])) for pkg in packages)
 
         if 'PACKAGES-PER-ARCH'in origin_cfg:
             config['PACKAGES-PER-ARCH'] = {} 
@@ -377,10 +625,10 @@ def load_build_config(cfg_dir, proj_root):
                 if not arch in config['TARGET_LIST']:
                     config['ret'] = 'Error! arch %s in PACKAGES-PER-ARCH tag is invalid!'%(arch)
                     return config
-                config['PACKAGES-PER-ARCH'][arch] = copy.deepcopy(origin_cfg['PACKAGES-PER-ARCH'][arch])
+                config['PACKAGES-PER-ARCH'][arch] = origin_cfg['PACKAGES-PER-ARCH'][arch]
                 for pkg in origin_cfg['PACKAGES-PER-ARCH'][arch]:
                     if not pkg in config['PACKAGES'][arch]:
-                        config['PACKAGES'][arch][pkg] = {}
+                        config['PACKAGES'][arch][pkg] = PackageInfo({})
 
                     path = origin_cfg['PACKAGES-PER-ARCH'][arch][pkg].get('Path', None)
                     if not path is None:
@@ -393,12 +641,7 @@ def load_build_config(cfg_dir, proj_root):
                         config['PACKAGES'][arch][pkg]['MakeTarget'] = target 
                     tools = origin_cfg['PACKAGES-PER-ARCH'][arch][pkg].get('Tools', None)
                     if not tools is None:
-                        config['PACKAGES'][arch][pkg]['Tools'] = tools
-
-        for arch in config['PACKAGES']:
-            for pkg in config['PACKAGES'][arch]:
-                if 'Tools' in config['PACKAGES'][arch][pkg]:
-                    config['PACKAGES'][arch][pkg]['Tools'] = set(config['PACKAGES'][arch][pkg]['Tools'])
+                        config['PACKAGES'][arch][pkg]['Tools'] = set(tools)
 
         for arch in config['BUILD_VARIANTS']:
             for variant in config['BUILD_VARIANTS'][arch]['VARIANTS']:
@@ -415,15 +658,16 @@ def load_build_config(cfg_dir, proj_root):
                     package_list = packages['PKG']
                     for pkg in list(package_list):
                         if 'Tools' in config['PACKAGES'][arch][pkg]:
-                            if arch_is_host(arch, config) and pkg != dep_pkg:
-                                package_list |= set(config['PACKAGES'][arch][pkg]['Tools'])
+                            if arch_is_host(arch, config):
+                                package_list |= set(config['PACKAGES'][arch][pkg]['Tools']) - set([pkg])
 
                         if 'Dependency' in config['PACKAGES'][arch][pkg]:
                             package_list |= set(config['PACKAGES'][arch][pkg]['Dependency'])
 
                     config['BUILD_VARIANTS'][arch]['VARIANTS'][variant]['PACKAGES'].append(list(package_list))
 
-                    graph =  nx.DiGraph()
+                    # package -> set of packages it depends on
+                    graph = {}
                     for pkg in package_list:
                         if not pkg in config['PACKAGES'][arch]:
                             config['ret'] = 'Arch: %s: Package %s is not defined in PACKAGE in file %s!'%(arch, pkg, cfg_file)
@@ -435,46 +679,43 @@ def load_build_config(cfg_dir, proj_root):
                                     config['ret'] = 'Arch: %s, Tool %s is not defined for host %s in file %s!'%(arch, dep_pkg, host_arch, cfg_file)
                                     return config
                                 if arch_is_host(arch, config) and pkg != dep_pkg:
-                                    graph.add_edge(pkg, dep_pkg)
+                                    add_graph_edge(graph, pkg, dep_pkg)
 
                         if 'Dependency' in config['PACKAGES'][arch][pkg]:
                             for dep_pkg in config['PACKAGES'][arch][pkg]['Dependency']:
                                 if not dep_pkg in config['PACKAGES'][arch]:
                                     config['ret'] = 'Arch: %s, Package %s is not defined in Dependency in file %s!'%(arch, dep_pkg, cfg_file)
                                     return config
-                                graph.add_edge(pkg, dep_pkg)
+                                add_graph_edge(graph, pkg, dep_pkg)
 
                     #for pkg in graph:
                     #    if not pkg in origin_cfg['GROUPS'][arch][group]['PACKAGES']:
                     #        print('File %s, arch %s, Group %s: package %s is depended but not list for build!'%(cfg_file, arch, group, pkg))
                     #        pass
 
-                    loop_str = ''
-                    for loop in nx.simple_cycles(graph):
-                        loop_str += str(loop) + ', '
-
-                    if loop_str:
-                        config['ret'] = 'File %s, arch %s: Loop dependency is found: %s!'%(cfg_file, arch, str(loop))
+                    loops = find_dependency_loops(graph)
+                    if loops:
+                        loop_str = '; '.join([' -> '.join(loop + [loop[0]]) for loop in loops])
+                        config['ret'] = 'File %s, arch %s, variant %s: Loop dependency is found: %s!'%(cfg_file, arch, variant, loop_str)
                         return config
 
-                    root_pkg = []
-                    #for pkg, degree in graph.in_degree().items():
-                    try:
-                        in_degree = graph.in_degree().items()
-                    except:
-                        in_degree = graph.in_degree()
-                    for pkg, degree in in_degree:
-                        if degree == 0:
-                            root_pkg.append(pkg)
+                    depended = set()
+                    for pkg in graph:
+                        depended |= graph[pkg]
+                    root_pkg = [pkg for pkg in graph if not pkg in depended]
                     for pkg in root_pkg:
-                        graph.add_edge(build_all_target, pkg)
+                        add_graph_edge(graph, build_all_target, pkg)
 
                     for pkg in package_list:
                         if not pkg in graph:
-                            graph.add_edge(build_all_target, pkg)
+                            add_graph_edge(graph, build_all_target, pkg)
 
                     config['BUILD_VARIANTS'][arch]['VARIANTS'][variant]['GRAPHS'].append(graph)
 
+                # all groups of a variant merged into one graph for ordering
+                config['BUILD_VARIANTS'][arch]['VARIANTS'][variant]['GRAPH'] = merge_graphs(
+                        config['BUILD_VARIANTS'][arch]['VARIANTS'][variant]['GRAPHS'])
+
     host_stage_dir = os.path.join(config['OUTPUT_DIR'], 'stage', config['HOST'])
     config['tool_path'] = (os.path.join(config['proj_root'], 'tools', 'bin', config['os_type']),
             os.path.join(host_stage_dir, 'bin'),
@@ -491,26 +732,119 @@ def add_definition(cmd, var, value = None):
     else:
         cmd += ['-D' + var + '=' + value]
 
+def get_cache_dir():
+    cache_dir = os.getenv('BC_CACHE_DIR')
+    if not cache_dir:
+        cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'buildCentral')
+    return cache_dir
+
+def get_sourced_scripts(source_file):
+    # find scripts run by commands like 'cd dir && source ./setenv.sh args'
+    scripts = []
+    cwd = os.getcwd()
+    for segment in source_file.replace('||', ';').replace('&&', ';').split(';'):
+        try:
+            words = shlex.split(segment)
+        except ValueError:
+            continue
+        if len(words) < 2:
+            continue
+        path = os.path.expanduser(os.path.expandvars(words[1]))
+        if words[0] == 'cd':
+            cwd = os.path.join(cwd, path)
+        elif words[0] in ('source', '.'):
+            scripts.append(os.path.normpath(os.path.join(cwd, path)))
+    return scripts
+
+def get_source_env_key(source_file):
+    h = hashlib.sha1()
+    h.update(source_file.encode('utf-8'))
+    for script in get_sourced_scripts(source_file):
+        try:
+            st = os.stat(script)
+            fd = open(script, 'rb')
+            content = fd.read()
+            fd.close()
+        except (IOError, OSError):
+            h.update(('%s missing\n'%(script)).encode('utf-8'))
+            continue
+        h.update(('%s %d %d '%(script, st.st_size, st.st_mtime_ns)).encode('utf-8'))
+        h.update(hashlib.sha1(content).hexdigest().encode('utf-8'))
+
+    # the parts of the parent environment the scripts are likely to depend on
+    env_names = set(['PATH', 'HOME', 'USER', 'SHELL', 'LANG'])
+    env_names |= set(re.findall(r'\$\{?([A-Za-z_][A-Za-z0-9_]*)', source_file))
+    for name in sorted(env_names):
+        h.update(('%s=%s\n'%(name, os.getenv(name, ''))).encode('utf-8'))
+    return h.hexdigest()
+
+def read_source_env_cache(cache_file, key):
+    try:
+        fd = open(cache_file, 'r')
+    except IOError:
+        return None
+    try:
+        cached = json.loads(fd.read())
+    except ValueError:
+        cached = {}
+    fd.close()
+    if cached.get('key') != key:
+        return None
+    return cached.get('env')
+
+def write_source_env_cache(cache_file, key, env):
+    try:
+        if not os.path.exists(os.path.dirname(cache_file)):
+            os.makedirs(os.path.dirname(cache_file))
+        fd = open(cache_file + '.%d.tmp'%(os.getpid()), 'w')
+        fd.write(json.dumps({'key' : key, 'env' : env}))
+        fd.close()
+        os.rename(cache_file + '.%d.tmp'%(os.getpid()), cache_file)
+    except (IOError, OSError):
+        pass
+
 source_env_cache = {}
-def load_env_from_source_file(source_file):
+# commands sourced again for --refresh-env in this run
+source_env_refreshed = set()
+def load_env_from_source_file(source_file, refresh = False):
     global source_env_cache
     env = {}
 
     if not source_file:
         return env
 
-    if source_file in source_env_cache:
-        return source_env_cache[source_file]
+    # one cache file per command; it is replaced whenever the key changes.
+    # The key is checked even for environments kept in memory since a daemon
+    # outlives edits of the scripts.
+    key = get_source_env_key(source_file)
+    if source_file in source_env_cache and source_env_cache[source_file][0] == key and \
+            (not refresh or source_file in source_env_refreshed):
+        return source_env_cache[source_file][1]
+
+    cache_file = os.path.join(get_cache_dir(), 'env',
+                              hashlib.sha1(source_file.encode('utf-8')).hexdigest() + '.json')
+    if not refresh:
+        cached_env = read_source_env_cache(cache_file, key)
+        if not cached_env is None:
+            source_env_cache[source_file] = (key, cached_env)
+            return cached_env
 
     #command = shlex.split("env -i bash -c ' " + source_file + " && env '")
     command = shlex.split("bash -c ' " + source_file + " && env'")
     proc = sp.Popen(command, stdout = sp.PIPE)
     for line in proc.stdout:
-        line = str(line)
-        (key, _, value) = line.partition('=')
-        env[key] = value.rstrip()
+        line = line.decode('utf-8', 'replace')
+        (key_name, sep, value) = line.partition('=')
+        if sep:
+            env[key_name] = value.rstrip()
     proc.communicate()
-    source_env_cache[source_file] = env
+    # only what the command set: the rest belongs to the shell mk runs in
+    env = dict((name, value) for name, value in env.items() if os.environ.get(name) != value)
+    if proc.returncode == 0:
+        write_source_env_cache(cache_file, key, env)
+    source_env_cache[source_file] = (key, env)
+    if refresh:
+        source_env_refreshed.add(source_file)
     return env
 
 def setup_global_build_env(arch, config):
@@ -521,7 +855,7 @@ def setup_global_build_env(arch, config):
             env += os.pathsep + pathes
         else:
             env = pathes
-        os.putenv('PATH', env)
+        os.environ['PATH'] = env
 
     if config['tool_lib']:
         pathes = os.pathsep.join(config['tool_lib'])
@@ -530,7 +864,7 @@ def setup_global_build_env(arch, config):
             env += os.pathsep + pathes
         else:
             env = pathes
-        os.putenv('LD_LIBRARY_PATH', env)
+        os.environ['LD_LIBRARY_PATH'] = env
 
 def get_generator_id(generator, arch, config):
     if not generator:
@@ -547,17 +881,64 @@ def get_generator_id(generator, arch, config):
 def check_generator(generator, arch, config):
     return cmake_generator[get_generator_id(generator, arch, config)]
 
+def is_ninja_generator(generator, arch, config):
+    return 'Ninja' in check_generator(generator, arch, config)
+
+ninja_version = {}
+
+def ninja_joins_jobserver():
+    # ninja takes part in a jobserver since 1.13; older ones run as many
+    # jobs as they like
+    if not 'version' in ninja_version:
+        ninja_version['version'] = None
+        for ninja in ['ninja', 'ninja-build']:
+            try:
+                out = sp.check_output([ninja, '--version'], stderr = sp.STDOUT).decode('utf-8', 'replace')
+            except (OSError, sp.CalledProcessError):
+                continue
+            m = re.match(r'(\d+)\.(\d+)', out.strip())
+            if m:
+                ninja_version['version'] = (int(m.group(1)), int(m.group(2)))
+                break
+    return ninja_version['version'] is not None and ninja_version['version'] >= (1, 13)
+
+# What is known about source trees, kept by a daemon while a file watcher
+# tells which trees changed; None when nothing watches the trees.
+source_cache = None
+
+def get_source_cache(path):
+    if source_cache is None:
+        return {}
+    return source_cache.setdefault(path, {})
+
+def invalidate_source_cache(changed):
+    # a change in a tree invalidates the tree and every tree containing it
+    if source_cache is None:
+        return
+    for path in changed:
+        path = os.path.normpath(path)
+        while True:
+            source_cache.pop(path, None)
+            parent = os.path.dirname(path)
+            if parent == path:
+                break
+            path = parent
+
 def get_build_cmd_type(package, arch, config):
     cmd_type = 'unknown'
     package_base = config['PACKAGES'][arch][package]['Path']
+    cached = get_source_cache(package_base)
+    if 'cmd_type' in cached:
+        return cached['cmd_type']
     if os.path.exists(os.path.join(package_base, 'CMakeLists.txt')): 
         cmd_type = 'cmake'
     elif os.path.exists(os.path.join(package_base, 'Makefile')) or os.path.exists(os.path.join(package_base, 'GNUMakefile')): 
         cmd_type = 'make'
+    cached['cmd_type'] = cmd_type
     return cmd_type
 
 def create_build_command(package, arch, variant, debug, verbose, stage, nr_jobs, generator, cmd_type, config, private_config, cmd):
-    sys_root = private_config['sys_root']
+    sys_root = list(private_config['sys_root'])
     stage_root = config['PACKAGES'][arch][package]['StageDir']
     if stage_root:
         sys_root += [stage_root]
@@ -567,12 +948,26 @@ def create_build_command(package, arch, variant, debug, verbose, stage, nr_jobs,
     lib_pathes = private_config['lib_search_path']
     head_pathes = private_config['head_search_path']
 
-    if get_generator_id(generator, arch, config) == 'nmake':
+    generator_id = get_generator_id(generator, arch, config)
+    if generator_id == 'nmake':
         make_tool = ['nmake']
         make_tool_with_job = ['nmake']
-    else:
+    elif nr_jobs:
         make_tool = ['make']
         make_tool_with_job = ['make', '-j', str(nr_jobs)]
+    else:
+        # job slots are handed out by the jobserver of buildCentral
+        make_tool = ['make']
+        make_tool_with_job = ['make']
+
+    # cmake drives the native tool of whatever generator it configured
+    cmake_build = ['cmake', '--build', config['PACKAGES'][arch][package]['BuildDir'],
+                   '--config', debug and 'Debug' or 'Release']
+    if verbose:
+        cmake_build.append('--verbose')
+    cmake_build_with_job = list(cmake_build)
+    if nr_jobs and generator_id != 'nmake':
+        cmake_build_with_job += ['--parallel', str(nr_jobs)]
 
     package_base = config['PACKAGES'][arch][package]['Path']
     make_target = config['PACKAGES'][arch][package]['MakeTarget']
@@ -581,7 +976,7 @@ def create_build_command(package, arch, variant, debug, verbose, stage, nr_jobs,
         private_config['env_var']['C_COMPILER'] = private_config['c_compiler']
         private_config['env_var']['CXX_COMPILER'] = private_config['cxx_compiler']
         if stage == 'clean':
-            cmd += make_tool +  ['clean']
+            cmd += cmake_build + ['--target', 'clean']
         elif stage == 'cmake':
             cmd += ['cmake']
             add_definition(cmd, 'PROJECT_ROOT', config['proj_root'])
@@ -625,6 +1020,10 @@ def create_build_command(package, arch, variant, debug, verbose, stage, nr_jobs,
             if private_config['cxx_flags']:        add_definition(cmd, 'CMAKE_CXX_FLAGS',  private_config['cxx_flags'])
             if private_config['release_flags']:    add_definition(cmd, 'REL_FLAGS',        private_config['release_flags'])
             if private_config['debug_flags']:      add_definition(cmd, 'DBG_FLAGS',        private_config['debug_flags'])
+            if private_config['compiler_launcher']:
+                launcher = ';'.join(private_config['compiler_launcher'].split())
+                add_definition(cmd, 'CMAKE_C_COMPILER_LAUNCHER', launcher)
+                add_definition(cmd, 'CMAKE_CXX_COMPILER_LAUNCHER', launcher)
             ld_flags = private_config['ld_flags']
             if  private_config['shared_ld_flags']: ld_flags += ' ' + private_config['shared_ld_flags']
             if ld_flags: add_definition(cmd, 'CMAKE_SHARED_LINKER_FLAGS', ld_flags)
@@ -654,15 +1053,16 @@ def create_build_command(package, arch, variant, debug, verbose, stage, nr_jobs,
             add_definition(cmd, 'PACKAGE_NAME', package)
             cmd.append(package_base)
         elif stage == 'make':
-            generator = check_generator(generator, arch, config) 
-            if 'Visual Studio' in generator:
-                cmd = []
-            else:
-                cmd += make_tool_with_job
-                if make_target:
-                    cmd += [make_target]
+            cmd += cmake_build_with_job
+            if make_target:
+                if make_target == 'install' and 'Visual Studio' in check_generator(generator, arch, config):
+                    make_target = 'INSTALL'
+                cmd += ['--target', make_target]
+        elif stage == 'build':
+            # the default target only, see export_ninja()
+            cmd += cmake_build_with_job
         elif stage == 'uninstall':
-            cmd += make_tool + ['uninstall']
+            cmd += cmake_build + ['--target', 'uninstall']
     elif cmd_type == 'make':
         # if exists 'Makefile' or 'GNUMakefile', make it;
         if stage == 'clean':
@@ -678,10 +1078,18 @@ def create_build_command(package, arch, variant, debug, verbose, stage, nr_jobs,
         else:
             return[]
 
-        if private_config['c_compiler']:
-            cmd += ['CC=' + private_config['c_compiler']]
-        if private_config['c_compiler']:
-            cmd += ['CXX=' + private_config['cxx_compiler']]
+        launcher = private_config['compiler_launcher']
+        if launcher:
+            # wrap the compilers make would use otherwise
+            cmd += ['CC=' + launcher + ' ' + (private_config['c_compiler'] or
+                                              private_config['env_var'].get('CC', 'cc'))]
+            cmd += ['CXX=' + launcher + ' ' + (private_config['cxx_compiler'] or
+                                               private_config['env_var'].get('CXX', 'c++'))]
+        else:
+            if private_config['c_compiler']:
+                cmd += ['CC=' + private_config['c_compiler']]
+            if private_config['c_compiler']:
+                cmd += ['CXX=' + private_config['cxx_compiler']]
 
         cflags = ''
         cxxflags = ''
@@ -740,47 +1148,89 @@ def create_build_command(package, arch, variant, debug, verbose, stage, nr_jobs,
             cmd += [' '.join(variables)]
 
     cmd = shlex.split(' '.join(cmd))
-    print(cmd)
     return private_config
 
-def figure_out_build_order(G, package, build_list):
-    idx = build_list.index(package)
-    for neighbor in G.neighbors(package):
-        if neighbor in build_list[0:idx]:
-            del(build_list[build_list.index(neighbor)])
-            build_list.insert(build_list.index(package) + 1, neighbor)
-        elif not neighbor in build_list[idx:]:
-            build_list.append(neighbor)
-
-    for neighbor in G.neighbors(package):
-        figure_out_build_order(G, neighbor, build_list)
-
-def generate_build_order_for_single_graph(G, package, build_list):
-    if not package in build_list:
-        build_list.append(package)
-        figure_out_build_order(G, package, build_list)
-
-def generate_all_build_order(graphs, build_list):
-    ordered_packages = []
+def merge_graphs(graphs):
+    # adjacency lists (package -> sorted dependencies) of the union of graphs
+    merged = {}
     for graph in graphs:
-        bp = []
-        generate_build_order_for_single_graph(graph, build_all_target, bp)
-        bp.reverse()
-        [ordered_packages.append(i) for i in bp if not i in ordered_packages]
- 
-    ordered_packages.reverse()
-    if build_all_target in ordered_packages:
-        ordered_packages.remove(build_all_target)
-    [build_list.append(i) for i in ordered_packages if not i in build_list]
+        for pkg in graph:
+            if not pkg in merged:
+                merged[pkg] = set()
+            merged[pkg] |= set(graph[pkg])
+    for pkg in merged:
+        merged[pkg] = sorted(merged[pkg])
+    return merged
+
+def get_merged_graph(graphs):
+    # accepts the GRAPH of a variant, a single group graph or a list of them;
+    # a graph given as a dict is checked and merged once
+    if isinstance(graphs, dict):
+        cached = merged_graphs.get(id(graphs))
+        if cached and cached[0] is graphs:
+            return cached[1]
+        merged = graphs
+        for pkg in graphs:
+            if not isinstance(graphs[pkg], list):
+                merged = merge_graphs([graphs])
+                break
+        merged_graphs[id(graphs)] = (graphs, merged)
+        return merged
+    return merge_graphs(graphs)
+
+def topological_order(graph, roots):
+    # dependencies first; iterative DFS visiting packages in sorted order so
+    # the result does not depend on hash order. O(V + E).
+    order = []
+    visited = set()
+    for root in sorted(roots):
+        if root in visited:
+            continue
+        visited.add(root)
+        work = [(root, iter(graph.get(root, ())))]
+        while work:
+            node, neighbors = work[-1]
+            for neighbor in neighbors:
+                if not neighbor in visited:
+                    visited.add(neighbor)
+                    work.append((neighbor, iter(graph.get(neighbor, ()))))
+                    break
+            else:
+                work.pop()
+                order.append(node)
+    return order
 
 def generate_build_order(graphs, package, build_list):
+    # build_list is kept in reverse build order: every package comes before
+    # the packages it depends on. Packages already in the list are kept and
+    # the whole list is ordered again.
+    graph = get_merged_graph(graphs)
+    roots = set(build_list)
     if package == build_all_target:
-        generate_all_build_order(graphs, build_list)
+        roots |= set(graph.get(build_all_target, ()))
+    elif package in graph:
+        roots.add(package)
     else:
-        for graph in graphs:
-            if not package in graph:
-                continue
-            generate_build_order_for_single_graph(graph, package, build_list)
+        return
+
+    order = [pkg for pkg in topological_order(graph, roots) if pkg != build_all_target]
+    order.reverse()
+    build_list[:] = order
+
+def get_build_order(graphs, packages):
+    # build order of packages and everything they depend on, dependencies
+    # first: one pass over the graph for the whole list
+    graph = get_merged_graph(graphs)
+    roots = set()
+    for package in packages:
+        if package == build_all_target:
+            roots |= set(graph.get(build_all_target, ()))
+        elif package in graph:
+            roots.add(package)
+    return [pkg for pkg in topological_order(graph, roots) if pkg != build_all_target]
+
+def generate_all_build_order(graphs, build_list):
+    generate_build_order(graphs, build_all_target, build_list)
 
 def get_tools(config, arch, packages):
     tools = set()
@@ -801,241 +1251,2018 @@ def unset_env(env_list):
         if env in os.environ:
             del os.environ[env]
 
-def do_build_packages(packages, arch, variant, debug, verbose, clean, not_build, nr_jobs, generator, config, output):
-    global build_stop
+def get_build_env(env_list):
+    env = dict(os.environ)
+    env.update(env_list)
+    return env
+
+def create_jobserver(nr_jobs, config):
+    # GNU make jobserver: a fifo loaded with one token per job slot. Each
+    # running package holds one token for its own make (the implicit slot of
+    # make); all other jobs of all makes are taken from the fifo so the whole
+    # build never runs more than nr_jobs jobs.
+    if config['os_type'] == 'windows':
+        return None
+    fifo_dir = tempfile.mkdtemp(prefix = 'bc-jobserver-')
+    fifo = os.path.join(fifo_dir, 'fifo')
+    os.mkfifo(fifo)
+    read_fd = os.open(fifo, os.O_RDONLY | os.O_NONBLOCK)
+    write_fd = os.open(fifo, os.O_WRONLY)
+    os.set_blocking(read_fd, True)
+    os.write(write_fd, b'+' * nr_jobs)
+    return {'path' : fifo, 'read' : read_fd, 'write' : write_fd, 'jobs' : nr_jobs}
+
+def close_jobserver(jobserver):
+    if not jobserver:
+        return
+    os.close(jobserver['read'])
+    os.close(jobserver['write'])
+    shutil.rmtree(os.path.dirname(jobserver['path']), ignore_errors=True)
+
+def jobserver_acquire(jobserver):
+    if not jobserver:
+        return None
+    while True:
+        try:
+            return os.read(jobserver['read'], 1)
+        except (BlockingIOError, InterruptedError):
+            # make switches the shared fifo to non-blocking mode
+            select.select([jobserver['read']], [], [])
+
+def jobserver_release(jobserver, token):
+    if jobserver and token:
+        os.write(jobserver['write'], token)
+
+def jobserver_env(jobserver):
+    if jobserver.get('fifo'):
+        # ninja only joins a jobserver given by the path of its fifo
+        return {'MAKEFLAGS' : ' -j --jobserver-auth=fifo:' + jobserver['path']}
+    fds = '%d,%d'%(jobserver['read'], jobserver['write'])
+    return {'MAKEFLAGS' : ' -j --jobserver-fds=' + fds + ' --jobserver-auth=' + fds}
+
+output_pump = None
+output_pump_lock = threading.Lock()
+
+def emit_output(job, chunk):
+    # whole lines only, so that the output of parallel builds is not mixed
+    # within a line
+    data = job['partial'] + chunk
+    end = data.rfind(b'\n') + 1
+    if not chunk or len(data) > 65536:
+        end = len(data)
+    job['partial'] = data[end:]
+    if end:
+        try:
+            job['output'](data[:end])
+        except Exception:
+            # e.g. the console went away: keep building and logging
+            job['output'] = lambda data: None
+        try:
+            job['log_fd'].write(data[:end])
+        except Exception:
+            pass
+
+def get_output_pump():
+    # one thread reads the output of all running build commands
+    global output_pump
+    with output_pump_lock:
+        if output_pump is None:
+            import selectors
+            wakeup = os.pipe()
+            selector = selectors.DefaultSelector()
+            selector.register(wakeup[0], selectors.EVENT_READ, None)
+            output_pump = {'selector' : selector, 'wakeup' : wakeup, 'add' : [], 'remove' : []}
+            thread = threading.Thread(target = run_output_pump, args = (output_pump,))
+            thread.daemon = True
+            thread.start()
+    return output_pump
+
+def notify_output_pump(pump, queue, job):
+    with output_pump_lock:
+        pump[queue].append(job)
+    os.write(pump['wakeup'][1], b'+')
+
+def run_output_pump(pump):
+    import selectors
+    selector = pump['selector']
+    while True:
+        for key, events in selector.select():
+            if key.data is None:
+                os.read(key.fd, 4096)
+                continue
+            job = key.data
+            try:
+                chunk = os.read(key.fd, 65536)
+            except OSError:
+                chunk = b''
+            emit_output(job, chunk)
+            if not chunk:
+                selector.unregister(key.fd)
+                job['done'].set()
+        with output_pump_lock:
+            add, pump['add'] = pump['add'], []
+            remove, pump['remove'] = pump['remove'], []
+        for job in add:
+            try:
+                selector.register(job['fd'], selectors.EVENT_READ, job)
+            except (OSError, ValueError, KeyError):
+                job['done'].set()
+        for job in remove:
+            if not job['done'].is_set():
+                selector.unregister(job['fd'])
+                job['done'].set()
+
+def read_output(job):
+    # no select() on pipes on Windows: read in the calling thread
+    while True:
+        chunk = os.read(job['fd'], 65536)
+        emit_output(job, chunk)
+        if not chunk or build_stop:
+            break
+    job['done'].set()
+
+def wait_build_command(pipe, usage):
+    # wait4() also tells the cpu time and the peak memory of the command
+    if not hasattr(os, 'wait4'):
+        pipe.wait()
+        return
+    pid, status, rusage = os.wait4(pipe.pid, 0)
+    if os.WIFSIGNALED(status):
+        pipe.returncode = -os.WTERMSIG(status)
+    else:
+        pipe.returncode = os.WEXITSTATUS(status)
+    if usage is not None:
+        maxrss = rusage.ru_maxrss
+        if sys.platform == 'darwin':
+            maxrss = maxrss // 1024
+        usage.update({'cpu' : round(rusage.ru_utime + rusage.ru_stime, 3), 'maxrss_kb' : maxrss})
+
+def run_build_command(cmd, work_path, env_list, output, log_fd, jobserver = None, usage = None):
     global build_cmd_pipe
+    # cwd and env are handed to the child directly so that several packages
+    # can be built from different threads at the same time
+    env = get_build_env(env_list)
+    pass_fds = ()
+    if jobserver:
+        env.update(jobserver_env(jobserver))
+        pass_fds = (jobserver['read'], jobserver['write'])
+    pipe = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.STDOUT, cwd = work_path, env = env, pass_fds = pass_fds)
+    build_cmd_pipe = pipe
+    job = {'fd' : pipe.stdout.fileno(), 'output' : output, 'log_fd' : log_fd,
+           'partial' : b'', 'done' : threading.Event()}
+    emit_output(job, (' '.join(cmd) + '\n').encode('utf-8'))
+    if os.name == 'nt':
+        read_output(job)
+    else:
+        pump = get_output_pump()
+        notify_output_pump(pump, 'add', job)
+        while not job['done'].wait(0.1):
+            if build_stop:
+                notify_output_pump(pump, 'remove', job)
+                job['done'].wait()
+    if build_stop:
+        pipe.terminate()
+        wait_build_command(pipe, usage)
+        pipe.stdout.close()
+        return None
+    wait_build_command(pipe, usage)
+    pipe.stdout.close()
+    return pipe.returncode
+
+def parse_worker_address(address):
+    # host:port for TCP, anything else is the path of a unix socket
+    import socket
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit():
+        return (socket.AF_INET, (host or '127.0.0.1', int(port)))
+    return (socket.AF_UNIX, address)
+
+def get_worker_secret():
+    # shared by mk and bc_worker.py: a worker runs whatever its clients send
+    return os.getenv('BC_WORKER_SECRET')
+
+def sign_worker_challenge(secret, challenge):
+    import hmac
+    return hmac.new(secret.encode('utf-8'), challenge.encode('ascii'), hashlib.sha256).hexdigest()
+
+def send_message(sock_file, msg):
+    # worker protocol: one json object per line
+    sock_file.write((json.dumps(msg) + '\n').encode('utf-8'))
+    sock_file.flush()
+
+def receive_message(sock_file):
+    line = sock_file.readline()
+    if not line:
+        return None
+    return json.loads(line.decode('utf-8'))
+
+def get_daemon_socket(proj_root):
+    # one daemon per project root
+    name = hashlib.sha1(os.path.realpath(proj_root).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(get_cache_dir(), 'daemon', name + '.sock')
+
+def run_daemon_client(argv):
+    # Let the daemon of the project run the command. Returns the exit code,
+    # or None when no daemon is running.
+    import socket
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+    daemon_socket = get_daemon_socket(guess_project_root(True))
+    if not os.path.exists(daemon_socket):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(daemon_socket)
+    except (IOError, OSError):
+        sock.close()
+        return None
+    sock_file = sock.makefile('rwb')
+    code = -1
+    try:
+        send_message(sock_file, {'type' : 'run', 'version' : worker_protocol_version, 'argv' : argv,
+                                 'prog' : os.path.basename(sys.argv[0]), 'cwd' : os.getcwd(),
+                                 'env' : dict(os.environ)})
+        while True:
+            try:
+                msg = receive_message(sock_file)
+            except KeyboardInterrupt:
+                # the daemon stops the build and still sends the summary
+                send_message(sock_file, {'type' : 'stop'})
+                continue
+            if msg is None:
+                print('Connection to the build daemon %s was lost!'%(daemon_socket))
+                break
+            if msg['type'] == 'output':
+                sys.stdout.flush()
+                if hasattr(sys.stdout, 'buffer'):
+                    sys.stdout.buffer.write(msg['data'].encode('latin-1'))
+                    sys.stdout.buffer.flush()
+                else:
+                    sys.stdout.write(msg['data'])
+            elif msg['type'] == 'exit':
+                code = msg['code']
+                break
+    except (IOError, OSError, ValueError) as e:
+        print('Connection to the build daemon %s: %s'%(daemon_socket, str(e)))
+    sock_file.close()
+    sock.close()
+    return code
+
+def connect_workers(addresses):
+    import socket
+    workers = []
+    secret = get_worker_secret()
+    if not secret:
+        return {'ret' : 'error', 'info' : 'BC_WORKER_SECRET is not set! Use the secret the workers were started with.',
+                'workers' : []}
+    for address in addresses:
+        family, addr = parse_worker_address(address)
+        try:
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            sock.connect(addr)
+            sock_file = sock.makefile('rwb')
+            hello = receive_message(sock_file)
+        except (OSError, ValueError) as e:
+            disconnect_workers(workers)
+            return {'ret' : 'error', 'info' : 'Cannot connect to worker %s: %s'%(address, str(e)), 'workers' : []}
+        if not hello or hello.get('version') != worker_protocol_version:
+            sock.close()
+            disconnect_workers(workers)
+            return {'ret' : 'error', 'info' : 'Worker %s does not speak protocol version %d!'%(address, worker_protocol_version),
+                    'workers' : []}
+        # the worker only builds for clients knowing its secret
+        reply = None
+        try:
+            send_message(sock_file, {'type' : 'auth', 'digest' : sign_worker_challenge(secret, hello['challenge'])})
+            reply = receive_message(sock_file)
+        except (OSError, ValueError):
+            pass
+        if not reply or reply.get('type') != 'ready':
+            sock.close()
+            disconnect_workers(workers)
+            return {'ret' : 'error', 'info' : 'Worker %s refused the connection! Check BC_WORKER_SECRET.'%(address),
+                    'workers' : []}
+        # 'sent' tracks the stage files the worker already has
+        workers.append({'address' : address, 'sock' : sock, 'file' : sock_file,
+                        'jobs' : hello['jobs'], 'host' : hello.get('host', address), 'sent' : {}})
+    return {'ret' : 'ok', 'info' : None, 'workers' : workers}
+
+def disconnect_workers(workers):
+    for worker in workers:
+        try:
+            worker['file'].close()
+            worker['sock'].close()
+        except OSError:
+            pass
+
+def scan_stage_dir(stage_dir):
+    # relative path -> (size, mtime) of everything below stage_dir
+    files = {}
+    for root, dirs, names in os.walk(stage_dir):
+        for name in names + [d for d in dirs if os.path.islink(os.path.join(root, d))]:
+            path = os.path.join(root, name)
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            files[os.path.relpath(path, stage_dir)] = (st.st_size, int(st.st_mtime))
+    return files
+
+def pack_stage_files(stage_dir, names):
+    import tarfile
+    import io
+    import base64
+    buf = io.BytesIO()
+    tar = tarfile.open(fileobj = buf, mode = 'w:gz')
+    for name in sorted(names):
+        tar.add(os.path.join(stage_dir, name), name, recursive = False)
+    tar.close()
+    return base64.b64encode(buf.getvalue()).decode('ascii')
+
+def is_inside_dir(path, top):
+    # after following the links which already exist
+    top = os.path.realpath(top)
+    path = os.path.realpath(path)
+    return path == top or path.startswith(os.path.join(top, ''))
+
+def unpack_stage_files(stage_dir, data):
+    # files which are already there are left alone, so a worker sharing the
+    # file system with the coordinator never rewrites them under a running build
+    import tarfile
+    import io
+    import base64
+    tar = tarfile.open(fileobj = io.BytesIO(base64.b64decode(data)), mode = 'r:gz')
+    names = []
+    for member in tar.getmembers():
+        if os.path.isabs(member.name) or '..' in member.name.split('/'):
+            continue
+        # nothing is written outside stage_dir, neither through links nor as links
+        if not is_inside_dir(os.path.join(stage_dir, os.path.dirname(member.name)), stage_dir):
+            continue
+        if member.issym() and not is_inside_dir(os.path.join(stage_dir, os.path.dirname(member.name), member.linkname), stage_dir):
+            continue
+        if member.islnk() and not is_inside_dir(os.path.join(stage_dir, member.linkname), stage_dir):
+            continue
+        names.append(member.name)
+        path = os.path.join(stage_dir, member.name)
+        if member.issym() and os.path.islink(path) and os.readlink(path) == member.linkname:
+            continue
+        if member.isfile() and os.path.isfile(path) and not os.path.islink(path):
+            st = os.stat(path)
+            if st.st_size == member.size and int(st.st_mtime) == int(member.mtime):
+                continue
+        if member.isdir() and os.path.isdir(path):
+            continue
+        tar.extract(member, stage_dir)
+    tar.close()
+    return names
+
+def run_remote_build(worker, pkg, steps, env_list, stage_dirs, config, output, log_fd):
+    # Build a package on a worker. The stage files the worker has not seen yet
+    # are sent along; the files the build installed into stage_dirs[0] come
+    # back and are unpacked into the local stage.
+    global build_stop
+    stage = []
+    for stage_dir in stage_dirs:
+        files = scan_stage_dir(stage_dir)
+        sent = worker['sent'].setdefault(stage_dir, {})
+        changed = [name for name in files if sent.get(name) != files[name]]
+        if changed:
+            stage.append({'dir' : stage_dir, 'data' : pack_stage_files(stage_dir, changed)})
+            for name in changed:
+                sent[name] = files[name]
+
+    output(('==== Building %s on worker %s\n'%(pkg, worker['host'])).encode('utf-8'))
+    try:
+        send_message(worker['file'], {'type' : 'build', 'package' : pkg, 'steps' : steps, 'env' : env_list,
+                                      'tool_path' : list(config['tool_path']), 'tool_lib' : list(config['tool_lib']),
+                                      'stage' : stage, 'stage_dir' : stage_dirs[0]})
+        while True:
+            msg = receive_message(worker['file'])
+            if build_stop:
+                # the worker stops the build when the connection goes away
+                disconnect_workers([worker])
+                return {'info' : 'ok', 'ret' : None, 'step' : None}
+            if msg is None:
+                break
+            if msg['type'] == 'output':
+                line = msg['data'].encode('latin-1')
+                output(line)
+                log_fd.write(line)
+            elif msg['type'] == 'result':
+                if msg.get('stage'):
+                    sent = worker['sent'].setdefault(stage_dirs[0], {})
+                    for name in unpack_stage_files(stage_dirs[0], msg['stage']):
+                        try:
+                            st = os.lstat(os.path.join(stage_dirs[0], name))
+                        except OSError:
+                            continue
+                        sent[name] = (st.st_size, int(st.st_mtime))
+                return {'info' : 'ok', 'ret' : msg['ret'], 'step' : msg.get('step', None)}
+    except (OSError, ValueError) as e:
+        output(('%s\n'%(str(e))).encode('utf-8'))
+    return {'info' : 'Lost connection to worker %s while building %s!'%(worker['address'], pkg),
+            'ret' : None, 'step' : None}
+
+def get_package_dependencies(graphs, packages):
+    # map each package to the nearest packages in the list it depends on,
+    # looking through packages which are not in the list. Waiting for those is
+    # enough since they wait for their own dependencies in turn.
+    graph = get_merged_graph(graphs)
+    pkg_set = set(packages)
+    frontier = {}
+
+    def get_frontier(pkg):
+        # packages of the list reachable from pkg without passing another one
+        work = [(pkg, iter(graph.get(pkg, ())))]
+        result = {pkg : set()}
+        while work:
+            node, neighbors = work[-1]
+            for neighbor in neighbors:
+                if neighbor in pkg_set:
+                    result[node].add(neighbor)
+                elif neighbor in frontier:
+                    result[node] |= frontier[neighbor]
+                elif not neighbor in result:
+                    result[neighbor] = set()
+                    work.append((neighbor, iter(graph.get(neighbor, ()))))
+                    break
+            else:
+                work.pop()
+                if node != pkg:
+                    frontier[node] = result[node]
+                    result[work[-1][0]] |= result[node]
+        return result[pkg]
 
-    if not variant:
-        variant = config['BUILD_VARIANTS'][arch]['DEFAULT_VARIANT']
+    deps = {}
+    for pkg in packages:
+        deps[pkg] = get_frontier(pkg)
+        deps[pkg].discard(pkg)
+    return deps
 
-    if not nr_jobs:
-        nr_jobs = multiprocessing.cpu_count()
-    cur_package = '' 
-    build_stop = 0
+def get_build_history_file(config, arch, variant):
+    return os.path.join(config['OUTPUT_DIR'], 'history', '%s-%s.json'%(arch, variant))
+
+def read_build_history(config, arch, variant):
+    try:
+        fd = open(get_build_history_file(config, arch, variant), 'r')
+    except IOError:
+        return {}
+    try:
+        history = json.loads(fd.read())
+    except ValueError:
+        history = {}
+    fd.close()
+    if not isinstance(history, dict):
+        return {}
+    return history
+
+def write_build_history(config, arch, variant, durations):
+    # durations of the packages built this time replace the old ones
+    if not durations:
+        return
+    history = read_build_history(config, arch, variant)
+    history.update(durations)
+    history_file = get_build_history_file(config, arch, variant)
+    try:
+        if not os.path.exists(os.path.dirname(history_file)):
+            os.makedirs(os.path.dirname(history_file))
+        fd = open(history_file + '.%d.tmp'%(os.getpid()), 'w')
+        fd.write(json.dumps(history, sort_keys = True, indent = 1))
+        fd.close()
+        os.rename(history_file + '.%d.tmp'%(os.getpid()), history_file)
+    except (IOError, OSError):
+        pass
+
+def get_critical_path_priority(jobs, deps, durations):
+    # Longest path from each job to the end of the build, in seconds of past
+    # builds. Jobs without history are estimated with the median duration.
+    known = sorted([durations[job] for job in jobs if job in durations])
+    estimate = known and known[len(known) // 2] or 1.0
+    users = dict((job, []) for job in jobs)
+    for job in jobs:
+        for dep in deps.get(job, ()):
+            if dep in users:
+                users[dep].append(job)
+    priority = {}
+    # jobs are in build order: every user comes after the jobs it depends on
+    for job in reversed(jobs):
+        remaining = max([priority.get(user, 0) for user in users[job]] or [0])
+        priority[job] = durations.get(job, estimate) + remaining
+    return priority
+
+def schedule_jobs(jobs, deps, nr_parallel, run_job, priority = None):
+    # Run jobs in the given order; a job is started once all jobs it depends
+    # on are done. Nothing new is started after the first failure, but jobs
+    # which are already running are allowed to finish. With priority, ready
+    # jobs with the longest path ahead of them are started first.
+    global build_stop
+    status = {}
     ret = 'ok'
-    log_base = os.path.join(config['LOG_DIR'], arch)
-    if not os.path.exists(log_base):
+    cur_job = ''
+
+    if nr_parallel <= 1:
+        for job in jobs:
+            cur_job = job
+            try:
+                ret = run_job(job)
+            except BaseException as e:
+                print(e)
+                ret = 'Fail running command!'
+            if ret == 'skip' or ret == 'cached':
+                status[job] = ret
+                ret = 'ok'
+                continue
+            if ret != 'ok':
+                status[job] = 'fail'
+                break
+            status[job] = 'done'
+        return {'info' : ret, 'package' : cur_job, 'status' : status}
+
+    cond = threading.Condition()
+    pending = list(jobs)
+    if priority:
+        # stable: jobs of the same priority keep the build order
+        pending.sort(key = lambda job: -priority.get(job, 0))
+    running = set()
+    failure = {'info' : 'ok', 'package' : ''}
+
+    def job_thread(job):
         try:
-            os.makedirs(log_base)
-        except:
-            return {'info' : 'Unable to create log dir %s'%(log_base), 'package' : None}
-    log_fd = open(os.path.join(log_base, 'log'), 'wb')
-    if build_all_target in packages:
-        del(packages[packages.index(build_all_target)])
+            result = run_job(job)
+        except BaseException as e:
+            print(e)
+            result = 'Fail running command!'
+        with cond:
+            running.discard(job)
+            if result == 'ok':
+                status[job] = 'done'
+            elif result == 'skip' or result == 'cached':
+                status[job] = result
+            else:
+                status[job] = 'fail'
+                if failure['info'] == 'ok':
+                    failure['info'] = result
+                    failure['package'] = job
+            cond.notify()
 
-    if nr_jobs < 1:
-        nr_jobs = 1
+    with cond:
+        try:
+            while True:
+                if failure['info'] == 'ok' and not build_stop:
+                    done = set([job for job in status if status[job] != 'fail'])
+                    for job in list(pending):
+                        if len(running) >= nr_parallel:
+                            break
+                        if deps.get(job, set()) - done:
+                            continue
+                        pending.remove(job)
+                        running.add(job)
+                        cur_job = job
+                        thread = threading.Thread(target = job_thread, args = (job,))
+                        thread.daemon = True
+                        thread.start()
+                if not running:
+                    break
+                cond.wait()
+        except BaseException as e:
+            print(e)
+            build_stop = 1
+            while running:
+                cond.wait()
+
+    if failure['info'] != 'ok':
+        return {'info' : failure['info'], 'package' : failure['package'], 'status' : status}
+    return {'info' : ret, 'package' : cur_job, 'status' : status}
+
+def get_fingerprint_file(config, arch, pkg, variant = None):
+    # stored next to BuildDir so that it survives removing the build tree;
+    # with variant, for a package whose paths are not configured here
+    if variant:
+        return get_package_paths(config, arch, pkg, variant)['BuildDir'] + '.fingerprint'
+    return config['PACKAGES'][arch][pkg]['BuildDir'] + '.fingerprint'
+
+def read_fingerprint_file(config, arch, pkg, variant = None):
+    # the fingerprint, then the artifact key if there is one
+    try:
+        fd = open(get_fingerprint_file(config, arch, pkg, variant), 'r')
+    except IOError:
+        return ['']
+    lines = fd.read().split()
+    fd.close()
+    return lines or ['']
 
-    pkg_cfg = {}
-    for pkg in packages:
-        cfg = copy.deepcopy(config['private'][arch])
-        import_configs(cfg, config['PACKAGES'][arch][pkg])
-        if 'PACKAGES-PER-ARCH' in config and arch in config['PACKAGES-PER-ARCH'] and pkg in config['PACKAGES-PER-ARCH'][arch]:
-            import_configs(cfg, config['PACKAGES-PER-ARCH'][arch][pkg])
-        cfg['env_var'].update(load_env_from_source_file(cfg['env_source_cmd'])) 
-        pkg_cfg[pkg] = cfg
+def read_fingerprint(config, arch, pkg, variant = None):
+    return read_fingerprint_file(config, arch, pkg, variant)[0]
 
-    setup_global_build_env(arch, config)
-    # ==== Clean packages ====
-    if clean:
-        for pkg in packages:
-            config_package_path(config, arch, pkg, variant)
-            cur_package = pkg
-            cmd_type = get_build_cmd_type(pkg, arch, config)
+def read_artifact_key(config, arch, pkg, variant = None):
+    lines = read_fingerprint_file(config, arch, pkg, variant)
+    return len(lines) > 1 and lines[1] or None
 
-            if cmd_type == 'cmake':
-                work_path = config['PACKAGES'][arch][pkg]['BuildDir']
-            else:
-                work_path = config['PACKAGES'][arch][pkg]['Path']
+def write_fingerprint(config, arch, pkg, fingerprint, artifact_key = None):
+    fingerprint_file = get_fingerprint_file(config, arch, pkg)
+    try:
+        # the build tree itself is on the worker for remote builds
+        if not os.path.isdir(os.path.dirname(fingerprint_file)):
+            os.makedirs(os.path.dirname(fingerprint_file))
+        fd = open(fingerprint_file + '.tmp', 'w')
+        fd.write(fingerprint + '\n')
+        if artifact_key:
+            fd.write(artifact_key + '\n')
+        fd.close()
+        os.rename(fingerprint_file + '.tmp', fingerprint_file)
+    except (IOError, OSError):
+        pass
+
+def remove_fingerprint(config, arch, pkg):
+    try:
+        os.remove(get_fingerprint_file(config, arch, pkg))
+    except OSError:
+        pass
+
+def hash_source_tree(path, excludes, h):
+    # name, size and modification time of every file is enough to notice an edit
+    if os.path.isfile(path):
+        st = os.stat(path)
+        h.update(('%s %d %d\n'%(path, st.st_size, st.st_mtime_ns)).encode('utf-8'))
+        return
+    cached = get_source_cache(path)
+    if cached.get('tree', (None,))[0] == excludes:
+        h.update(cached['tree'][1])
+        return
+    lines = []
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted([d for d in dirs if not d in ('.git', '.svn', '.repo')
+                          and not os.path.join(root, d) in excludes])
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            try:
+                st = os.lstat(file_path)
+            except OSError:
+                continue
+            lines.append('%s %d %d\n'%(os.path.relpath(file_path, path), st.st_size, st.st_mtime_ns))
+    tree = ''.join(lines).encode('utf-8')
+    cached['tree'] = (excludes, tree)
+    h.update(tree)
+
+file_digests = {}
+
+def get_file_digest(path, st):
+    key = (path, st.st_size, st.st_mtime_ns)
+    if not key in file_digests:
+        h = hashlib.sha1()
+        fd = open(path, 'rb')
+        while True:
+            data = fd.read(1 << 20)
+            if not data:
+                break
+            h.update(data)
+        fd.close()
+        file_digests[key] = h.hexdigest()
+    return file_digests[key]
+
+def hash_source_contents(path, excludes, h):
+    # relative name and content of every file: the same in every checkout
+    if os.path.isfile(path):
+        h.update(('%s %s\n'%(os.path.basename(path), get_file_digest(path, os.stat(path)))).encode('utf-8'))
+        return
+    cached = get_source_cache(path)
+    if cached.get('contents', (None,))[0] == excludes:
+        h.update(cached['contents'][1])
+        return
+    lines = []
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted([d for d in dirs if not d in ('.git', '.svn', '.repo')
+                          and not os.path.join(root, d) in excludes])
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            try:
+                st = os.lstat(file_path)
+                if os.path.islink(file_path):
+                    digest = '-> ' + os.readlink(file_path)
+                else:
+                    digest = get_file_digest(file_path, st)
+            except (IOError, OSError):
+                continue
+            lines.append('%s %s\n'%(os.path.relpath(file_path, path).replace(os.sep, '/'), digest))
+    contents = ''.join(lines).encode('utf-8')
+    cached['contents'] = (excludes, contents)
+    h.update(contents)
+
+def get_package_fingerprint(pkg, arch, variant, debug, cmd_type, config, pkg_cfg, cmds):
+    pkg_info = config['PACKAGES'][arch][pkg]
+    h = hashlib.sha1()
+    h.update(json.dumps([pkg, arch, variant, bool(debug), cmd_type, cmds, pkg_cfg],
+                        sort_keys = True).encode('utf-8'))
+
+    excludes = set([pkg_info['BuildDir'], config['OUTPUT_DIR']])
+    hash_source_tree(pkg_info['Path'], excludes, h)
+
+    for dep_pkg in sorted(pkg_info.get('Dependency', [])):
+        if dep_pkg in config['PACKAGES'][arch]:
+            h.update(('%s:%s\n'%(dep_pkg, read_fingerprint(config, arch, dep_pkg, variant))).encode('utf-8'))
+    host_arch = config['os_type']
+    if host_arch in config['BUILD_VARIANTS']:
+        tools_variant = config['BUILD_VARIANTS'][host_arch]['DEFAULT_VARIANT']
+        for tool in sorted(pkg_info.get('Tools', [])):
+            if tool in config['PACKAGES'][host_arch] and tool != pkg:
+                h.update(('%s(host):%s\n'%(tool, read_fingerprint(config, host_arch, tool, tools_variant))).encode('utf-8'))
+    return h.hexdigest()
+
+def package_is_installed(config, arch, pkg):
+    # the stage dir might have been wiped without touching the build tree
+    manifest_file = os.path.join(config['PACKAGES'][arch][pkg]['BuildDir'], 'install_manifest.txt')
+    try:
+        fd = open(manifest_file, 'r')
+    except IOError:
+        return True
+    files = [i for i in fd.read().split('\n') if i]
+    fd.close()
+    for f in files:
+        if not os.path.lexists(f):
+            return False
+    return True
+
+toolchain_ids = {}
+
+def get_toolchain_id(pkg_cfg):
+    # the compilers and tools by name and content
+    tools = [pkg_cfg[item] for item in ['c_compiler', 'cxx_compiler', 'asm_compiler', 'archiver',
+                                        'toolchain_file', 'toolchain_root'] if pkg_cfg[item]]
+    if not pkg_cfg['c_compiler'] and not pkg_cfg['cxx_compiler']:
+        tools += ['cc', 'c++']
+    tools += ['cmake', 'make']
+    path = pkg_cfg['env_var'].get('PATH', os.getenv('PATH'))
+    key = (path, tuple(tools))
+    if key in toolchain_ids:
+        return toolchain_ids[key]
+    h = hashlib.sha1(platform.machine().encode('utf-8'))
+    for tool in tools:
+        if not os.path.isabs(tool):
+            tool = shutil.which(tool, path = path) or tool
+        tool = os.path.realpath(tool)
+        try:
+            digest = get_file_digest(tool, os.stat(tool))
+        except (IOError, OSError):
+            h.update(('%s missing\n'%(os.path.basename(tool))).encode('utf-8'))
+            continue
+        h.update(('%s %s\n'%(os.path.basename(tool), digest)).encode('utf-8'))
+    toolchain_ids[key] = h.hexdigest()
+    return toolchain_ids[key]
+
+def get_artifact_cache_dir():
+    return os.path.join(get_cache_dir(), 'artifacts')
+
+def get_artifact_cache_size():
+    # in MB
+    try:
+        return int(os.getenv('BC_ARTIFACT_CACHE_SIZE', '5120'))
+    except ValueError:
+        return 5120
 
-            def setup_environment():
-                os.chdir(work_path)
-                setup_env(pkg_cfg[pkg]['env_var'])
+def lock_artifact_cache(exclusive):
+    # serializes the jobs and mk instances sharing the cache; readers only
+    # have to be protected against eviction
+    try:
+        import fcntl
+    except ImportError:
+        return None
+    cache_dir = get_artifact_cache_dir()
+    # other jobs might create it at the same time
+    os.makedirs(cache_dir, exist_ok = True)
+    fd = open(os.path.join(cache_dir, 'lock'), 'a')
+    fcntl.flock(fd, exclusive and fcntl.LOCK_EX or fcntl.LOCK_SH)
+    return fd
+
+def unlock_artifact_cache(fd):
+    if fd:
+        fd.close()
 
-            env_set = False 
-            if os.path.exists(work_path):
-                try:
-                    if clean == 'uninstall_clean' and should_install(config, arch, pkg):
-                        cmd = []
-                        create_build_command(pkg, arch, variant, debug, verbose, 'uninstall',
-                                                   nr_jobs, generator, cmd_type, config, pkg_cfg[pkg], cmd)
-                        if cmd:
-                            if config['os_type'] == 'windows':
-                                env_set = True 
-                                setup_environment()
-                                build_cmd_pipe = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.STDOUT)
-                            else:
-                                build_cmd_pipe = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.STDOUT, preexec_fn = setup_environment)
-                            while True:
-                                line = build_cmd_pipe.stdout.readline()
-                                if not line: break
-                                output(line)
-                                log_fd.write(line)
-                                if build_stop:
-                                    break
-                            if build_stop:
-                                break
-                except:
-                    pass
+def get_artifact_key(pkg, arch, variant, debug, cmd_type, config, pkg_cfg, cmds):
+    # Like the fingerprint, but from file contents and with the project root
+    # and the output dir taken out of the settings, so that other checkouts
+    # and machines find the same artifacts. None while a dependency has no
+    # artifact key.
+    pkg_info = config['PACKAGES'][arch][pkg]
+    settings = json.dumps([pkg, arch, variant, bool(debug), cmd_type, cmds, pkg_cfg], sort_keys = True)
+    for path, name in [(config['OUTPUT_DIR'], '$(OUTPUT_DIR)'), (config['proj_root'], '$(PROJECT_ROOT)')]:
+        settings = settings.replace(json.dumps(path)[1:-1], name)
+    h = hashlib.sha1(settings.encode('utf-8'))
+    h.update(('%s\n'%(get_toolchain_id(pkg_cfg))).encode('utf-8'))
+
+    excludes = set([pkg_info['BuildDir'], config['OUTPUT_DIR']])
+    hash_source_contents(pkg_info['Path'], excludes, h)
+
+    for dep_pkg in sorted(pkg_info.get('Dependency', [])):
+        if dep_pkg in config['PACKAGES'][arch]:
+            key = read_artifact_key(config, arch, dep_pkg, variant)
+            if not key:
+                return None
+            h.update(('%s:%s\n'%(dep_pkg, key)).encode('utf-8'))
+    host_arch = config['os_type']
+    if host_arch in config['BUILD_VARIANTS']:
+        tools_variant = config['BUILD_VARIANTS'][host_arch]['DEFAULT_VARIANT']
+        for tool in sorted(pkg_info.get('Tools', [])):
+            if tool in config['PACKAGES'][host_arch] and tool != pkg:
+                key = read_artifact_key(config, host_arch, tool, tools_variant)
+                if not key:
+                    return None
+                h.update(('%s(host):%s\n'%(tool, key)).encode('utf-8'))
+    return h.hexdigest()
+
+def restore_artifact(config, arch, pkg, key):
+    # unpack a cached build into the stage; the manifest is written as if
+    # the package had been installed
+    import tarfile
+    pkg_info = config['PACKAGES'][arch][pkg]
+    artifact = os.path.join(get_artifact_cache_dir(), key + '.tar.gz')
+    if not os.path.exists(artifact):
+        return False
+    lock = None
+    try:
+        lock = lock_artifact_cache(False)
+        tar = tarfile.open(artifact, 'r:gz')
+        members = [m for m in tar.getmembers()
+                   if not os.path.isabs(m.name) and not '..' in m.name.split('/')]
+        for member in members:
+            path = os.path.join(pkg_info['StageDir'], member.name)
+            if os.path.islink(path) or (os.path.exists(path) and not os.path.isdir(path)):
+                os.remove(path)
+            tar.extract(member, pkg_info['StageDir'])
+        tar.close()
+        # most recently used
+        os.utime(artifact, None)
+    except (IOError, OSError, tarfile.TarError):
+        return False
+    finally:
+        unlock_artifact_cache(lock)
 
-                try:
-                    if clean == 'uninstall_clean' or clean == 'clean_only':
-                        cmd = []
-                        create_build_command(pkg, arch, variant, debug, verbose, 'clean',
-                                             nr_jobs, generator, cmd_type, config, pkg_cfg[pkg], cmd)
-                        if cmd:
-                            if config['os_type'] == 'windows':
-                                if not env_set:
-                                    env_set = True
-                                    setup_environment()
-                                build_cmd_pipe = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.STDOUT)
-                            else:
-                                build_cmd_pipe = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.STDOUT, preexec_fn = setup_environment)
-                            while True:
-                                line = build_cmd_pipe.stdout.readline()
-                                if not line: break
-                                output(line)
-                                log_fd.write(line)
-                                if build_stop:
-                                    break
-                            if build_stop:
-                                break
-
-                except:
-                    pass
-                try:
-                    if cmd_type == 'cmake':
-                        print('Removing working directory: ' + work_path)
-                        shutil.rmtree(work_path, ignore_errors=True)
-                except:
-                    pass
+    if not os.path.isdir(pkg_info['BuildDir']):
+        os.makedirs(pkg_info['BuildDir'])
+    fd = open(os.path.join(pkg_info['BuildDir'], 'install_manifest.txt'), 'w')
+    fd.write('\n'.join([os.path.join(pkg_info['StageDir'], m.name) for m in members if not m.isdir()]))
+    fd.close()
+    return True
 
-                if build_stop:
-                    break
+def store_artifact(config, arch, pkg, key):
+    # only what the package installed into the stage, as listed in its manifest
+    import tarfile
+    pkg_info = config['PACKAGES'][arch][pkg]
+    manifest_file = os.path.join(pkg_info['BuildDir'], 'install_manifest.txt')
+    try:
+        fd = open(manifest_file, 'r')
+    except IOError:
+        return
+    files = [i for i in fd.read().split('\n') if i]
+    fd.close()
+    stage_dir = os.path.join(os.path.normpath(pkg_info['StageDir']), '')
+    for f in files:
+        if not os.path.normpath(f).startswith(stage_dir) or not os.path.lexists(f):
+            return
+
+    cache_dir = get_artifact_cache_dir()
+    lock = None
+    tmp_file = None
+    try:
+        os.makedirs(cache_dir, exist_ok = True)
+        fd, tmp_file = tempfile.mkstemp(prefix = key + '.', dir = cache_dir)
+        os.close(fd)
+        os.chmod(tmp_file, 0o644)
+        tar = tarfile.open(tmp_file, 'w:gz')
+        for f in sorted(files):
+            tar.add(f, os.path.relpath(f, stage_dir), recursive = False)
+        tar.close()
+        lock = lock_artifact_cache(True)
+        os.rename(tmp_file, os.path.join(cache_dir, key + '.tar.gz'))
+        evict_artifacts(cache_dir, get_artifact_cache_size() * 1024 * 1024)
+    except (IOError, OSError, tarfile.TarError):
+        if tmp_file and os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    finally:
+        unlock_artifact_cache(lock)
+
+def evict_artifacts(cache_dir, max_size):
+    # least recently used first; called with the cache locked
+    artifacts = []
+    total = 0
+    for name in os.listdir(cache_dir):
+        if not name.endswith('.tar.gz'):
+            continue
+        try:
+            st = os.stat(os.path.join(cache_dir, name))
+        except OSError:
+            continue
+        artifacts.append((st.st_mtime, name, st.st_size))
+        total += st.st_size
+    artifacts.sort()
+    for mtime, name, size in artifacts:
+        if total <= max_size:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, name))
+        except OSError:
+            continue
+        total -= size
+
+def get_configure_stamp(cmd, pkg, arch, config, pkg_cfg):
+    # everything that makes a new cmake configure necessary: the exact command
+    # line (definitions, generator, toolchain file), the environment and the
+    # cmake scripts of the package, the rules and the toolchain
+    h = hashlib.sha1()
+    h.update(json.dumps([cmd, pkg_cfg['env_var']], sort_keys = True).encode('utf-8'))
+
+    cmake_files = []
+    for item in cmd:
+        if item.startswith('-DCMAKE_TOOLCHAIN_FILE='):
+            cmake_files.append(item.partition('=')[2])
+    rule_dir = os.path.join(config['proj_root'], 'tools', 'buildCentral', 'rules')
+    search_dirs = [config['PACKAGES'][arch][pkg]['Path'], rule_dir]
+    excludes = set([config['PACKAGES'][arch][pkg]['BuildDir'], config['OUTPUT_DIR']])
+    for search_dir in search_dirs:
+        for root, dirs, files in os.walk(search_dir):
+            dirs[:] = sorted([d for d in dirs if not d in ('.git', '.svn', '.repo')
+                              and not os.path.join(root, d) in excludes])
+            for name in sorted(files):
+                if name == 'CMakeLists.txt' or name.endswith('.cmake'):
+                    cmake_files.append(os.path.join(root, name))
+
+    for cmake_file in cmake_files:
+        try:
+            st = os.stat(cmake_file)
+        except OSError:
+            h.update(('%s missing\n'%(cmake_file)).encode('utf-8'))
+            continue
+        h.update(('%s %d %d\n'%(cmake_file, st.st_size, st.st_mtime_ns)).encode('utf-8'))
+    return h.hexdigest()
+
+def configure_is_up_to_date(work_path, stamp):
+    if not os.path.exists(os.path.join(work_path, 'CMakeCache.txt')):
+        return False
+    try:
+        fd = open(os.path.join(work_path, 'bc_configure.stamp'), 'r')
+    except IOError:
+        return False
+    old_stamp = fd.read().strip()
+    fd.close()
+    return old_stamp == stamp
+
+def drop_stale_cmake_cache(work_path, cmd):
+    # cmake refuses to configure a build dir for another generator
+    if not '-G' in cmd:
+        return
+    generator = cmd[cmd.index('-G') + 1]
+    cache_file = os.path.join(work_path, 'CMakeCache.txt')
+    try:
+        fd = open(cache_file, 'r')
+    except IOError:
+        return
+    cached = {}
+    for line in fd:
+        for name in ('CMAKE_GENERATOR', 'CMAKE_EXTRA_GENERATOR'):
+            if line.startswith(name + ':'):
+                cached[name] = line.partition('=')[2].strip()
+    fd.close()
+    old_generator = cached.get('CMAKE_GENERATOR')
+    if cached.get('CMAKE_EXTRA_GENERATOR'):
+        # e.g. 'Eclipse CDT4' and 'Unix Makefiles' for 'Eclipse CDT4 - Unix Makefiles'
+        old_generator = cached['CMAKE_EXTRA_GENERATOR'] + ' - ' + old_generator
+    if old_generator is not None and old_generator != generator:
+        os.remove(cache_file)
+        shutil.rmtree(os.path.join(work_path, 'CMakeFiles'), ignore_errors=True)
+
+def write_configure_stamp(work_path, stamp):
+    stamp_file = os.path.join(work_path, 'bc_configure.stamp')
+    if stamp is None:
+        try:
+            os.remove(stamp_file)
+        except OSError:
+            pass
+        return
+    try:
+        fd = open(stamp_file, 'w')
+        fd.write(stamp + '\n')
+        fd.close()
+    except IOError:
+        pass
+
+def get_package_log_dir(config, arch, variant, pkg):
+    return os.path.join(config['LOG_DIR'], arch, variant, pkg)
+
+def open_package_log(config, arch, variant, pkg, stage):
+    # one log per package and stage, compressed when the stage is done
+    log_dir = get_package_log_dir(config, arch, variant, pkg)
+    if not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+    log_file = os.path.join(log_dir, stage + '.log')
+    for f in [log_file, log_file + '.gz']:
+        if os.path.exists(f):
+            os.remove(f)
+    package_logs[(arch, variant, pkg)] = log_file + '.gz'
+    return open(log_file, 'wb', 1 << 16)
+
+def close_package_log(log_fd):
+    import gzip
+    log_file = log_fd.name
+    log_fd.close()
+    try:
+        src = open(log_file, 'rb')
+        dst = gzip.open(log_file + '.gz', 'wb')
+        shutil.copyfileobj(src, dst)
+        dst.close()
+        src.close()
+        os.remove(log_file)
+    except (IOError, OSError):
+        pass
+
+def read_log_tail(log_file, nr_lines):
+    import gzip
+    from collections import deque
+    try:
+        if log_file.endswith('.gz'):
+            fd = gzip.open(log_file, 'rb')
+        else:
+            fd = open(log_file, 'rb')
+        lines = deque(fd, nr_lines)
+        fd.close()
+    except (IOError, OSError):
+        return b''
+    return b''.join(lines)
+
+def get_package_output(output, pkg, config):
+    # every line on the console starts with the package name; quiet mode
+    # shows progress only
+    if config.get('quiet'):
+        return lambda data: None
+    prefix = ('[%s] '%(pkg)).encode('utf-8')
+    def package_output(data):
+        end = data.endswith(b'\n')
+        lines = data.split(b'\n')
+        if end:
+            lines.pop()
+        output(prefix + (b'\n' + prefix).join(lines) + (end and b'\n' or b''))
+    return package_output
+
+def reset_build_state():
+    # a daemon runs one command after the other in the same process
+    global trace_origin
+    with trace_lock:
+        del trace_events[:]
+        trace_origin = time.time()
+    compiler_cache_stats.clear()
+    package_logs.clear()
+    source_env_refreshed.clear()
+    merged_graphs.clear()
+
+def set_trace_lane(lane):
+    trace_local.lane = lane
+
+def add_trace_event(name, category, start, end, args = None):
+    event = {'name' : name, 'cat' : category, 'ph' : 'X', 'pid' : os.getpid(),
+             'tid' : getattr(trace_local, 'lane', 0),
+             'ts' : int((start - trace_origin) * 1000000), 'dur' : int((end - start) * 1000000)}
+    if args:
+        event['args'] = args
+    with trace_lock:
+        trace_events.append(event)
+
+def write_trace(trace_file):
+    # Chrome trace event format: chrome://tracing, https://ui.perfetto.dev
+    with trace_lock:
+        lanes = sorted(set([event['tid'] for event in trace_events]))
+        events = [{'name' : 'process_name', 'ph' : 'M', 'pid' : os.getpid(), 'tid' : 0,
+                   'args' : {'name' : 'buildCentral'}}]
+        for lane in lanes:
+            events.append({'name' : 'thread_name', 'ph' : 'M', 'pid' : os.getpid(), 'tid' : lane,
+                           'args' : {'name' : lane and 'slot %d'%(lane) or 'buildCentral'}})
+        events += trace_events
+    try:
+        if not os.path.isdir(os.path.dirname(trace_file)):
+            os.makedirs(os.path.dirname(trace_file))
+        fd = open(trace_file, 'w')
+        fd.write(json.dumps({'traceEvents' : events, 'displayTimeUnit' : 'ms'}))
+        fd.close()
+    except (IOError, OSError):
+        return False
+    return True
 
-            if env_set:
-                env_set = False
-                unset_env(pkg_cfg[pkg]['env_var'])
+def run_package_stage(config, arch, variant, pkg, stage, cmd, work_path, env_list, output, jobserver = None):
+    # one stage of a package: own log and one trace event
+    log_fd = open_package_log(config, arch, variant, pkg, stage)
+    usage = {}
+    start = time.time()
+    try:
+        ret_code = run_build_command(cmd, work_path, env_list, output, log_fd, jobserver, usage)
+    finally:
+        close_package_log(log_fd)
+        usage['arch'] = arch
+        usage['variant'] = variant
+        add_trace_event('%s: %s'%(pkg, stage), stage, start, time.time(), usage)
+    return ret_code
+
+def setup_compiler_cache(pkg, arch, config, pkg_cfg):
+    # ccache gets a cache per arch and a stats log per package
+    launcher = pkg_cfg['compiler_launcher']
+    if not launcher or not 'ccache' in os.path.basename(launcher.split()[0]):
+        return None
+    if not 'CCACHE_DIR' in pkg_cfg['env_var']:
+        pkg_cfg['env_var']['CCACHE_DIR'] = os.path.join(config['OUTPUT_DIR'], 'ccache', arch)
+    stats_log = config['PACKAGES'][arch][pkg]['BuildDir'] + '.ccache.log'
+    pkg_cfg['env_var']['CCACHE_STATSLOG'] = stats_log
+    return stats_log
+
+def reset_compiler_cache_stats(stats_log):
+    if os.path.exists(stats_log):
+        os.remove(stats_log)
+    elif not os.path.isdir(os.path.dirname(stats_log)):
+        os.makedirs(os.path.dirname(stats_log))
+
+def read_compiler_cache_stats(stats_log):
+    # ccache (4.0 and later) writes one line per counter it increments
+    stats = {'hits' : 0, 'misses' : 0}
+    try:
+        fd = open(stats_log, 'r')
+    except IOError:
+        return stats
+    for line in fd:
+        line = line.strip()
+        if line in ['direct_cache_hit', 'preprocessed_cache_hit']:
+            stats['hits'] += 1
+        elif line == 'cache_miss':
+            stats['misses'] += 1
+    fd.close()
+    return stats
+
+trash_reaper_script = '''
+import os, sys, shutil
+try:
+    os.nice(19)
+except (AttributeError, OSError):
+    pass
+for name in os.listdir(sys.argv[1]):
+    shutil.rmtree(os.path.join(sys.argv[1], name), ignore_errors=True)
+'''
 
-    if not_build:
-        return {'info' : ret, 'package' : None}
+def get_trash_dir(config):
+    return os.path.join(config['OUTPUT_DIR'], 'trash')
 
-    # ==== Build packages ====
-    env_set = False
+def move_to_trash(path, config):
+    # a rename is done at once; the tree is deleted later by the reaper
+    trash_dir = get_trash_dir(config)
     try:
-        for pkg in packages:
-            config_package_path(config, arch, pkg, variant)
-            cur_package = pkg
-            cmd_type = get_build_cmd_type(pkg, arch, config)
-            if cmd_type == 'cmake':
-                work_path = config['PACKAGES'][arch][pkg]['BuildDir']
-                if not os.path.exists(work_path):
-                    try:
-                        os.makedirs(work_path)
-                    except:
-                        return {'info' : 'Package %s: cannot create work path %s!'%s(pkg, work_path)}
-            elif cmd_type == 'make':
-                work_path = config['PACKAGES'][arch][pkg]['Path']
-                if not os.path.exists(work_path):
-                    ret = 'Work path for package %s does not exist!'%(pkg)
-                    break
-            else:
-                ret = 'Fail to create build command for package %s! Possibly there is no CMakeList, Makefile or GNUMakefile for the package.'%(pkg)
-                break
+        if not os.path.exists(trash_dir):
+            os.makedirs(trash_dir)
+        os.rename(path, os.path.join(tempfile.mkdtemp(prefix = os.path.basename(path) + '-', dir = trash_dir), 'tree'))
+    except OSError:
+        # e.g. the output dir is on another file system
+        shutil.rmtree(path, ignore_errors=True)
+
+def start_trash_reaper(config):
+    # a process of its own which outlives mk: nobody waits for the deletes
+    trash_dir = get_trash_dir(config)
+    try:
+        if not os.listdir(trash_dir):
+            return
+        sp.Popen([sys.executable, '-c', trash_reaper_script, trash_dir], stdin = sp.DEVNULL,
+                 stdout = sp.DEVNULL, stderr = sp.DEVNULL, start_new_session = True)
+    except OSError:
+        pass
+
+def uninstall_manifest(config, arch, variant, pkg, work_path, output):
+    # what the uninstall target of rule_base.cmake does, without a build tree
+    try:
+        fd = open(os.path.join(work_path, 'install_manifest.txt'), 'r')
+        files = [line.strip() for line in fd if line.strip()]
+        fd.close()
+    except (IOError, OSError):
+        return
+    log_fd = open_package_log(config, arch, variant, pkg, 'uninstall')
+    try:
+        for path in files:
+            line = ('-- Uninstalling %s\n'%(path)).encode('utf-8')
+            output(line)
+            log_fd.write(line)
+            try:
+                if os.path.islink(path) or os.path.isfile(path):
+                    os.remove(path)
+            except OSError as e:
+                line = ('Problem when removing %s: %s\n'%(path, str(e))).encode('utf-8')
+                output(line)
+                log_fd.write(line)
+    finally:
+        close_package_log(log_fd)
+
+def clean_package(pkg, arch, variant, debug, verbose, clean, nr_jobs, generator, config, pkg_cfg, output):
+    config_package_path(config, arch, pkg, variant)
+    cmd_type = get_build_cmd_type(pkg, arch, config)
+
+    if cmd_type == 'cmake':
+        work_path = config['PACKAGES'][arch][pkg]['BuildDir']
+    else:
+        work_path = config['PACKAGES'][arch][pkg]['Path']
 
-            def setup_environment():
-                os.chdir(work_path)
-                setup_env(pkg_cfg[pkg]['env_var'])
+    remove_fingerprint(config, arch, pkg)
+    if not os.path.exists(work_path):
+        return
 
-            env_set = False
+    # a package restored from the binary cache has a manifest but no cmake cache
+    configured = cmd_type != 'cmake' or os.path.exists(os.path.join(work_path, 'CMakeCache.txt'))
+    try:
+        if clean == 'uninstall_clean' and should_install(config, arch, pkg) and not configured:
+            uninstall_manifest(config, arch, variant, pkg, work_path, output)
+        elif clean == 'uninstall_clean' and should_install(config, arch, pkg):
             cmd = []
-            create_build_command(pkg, arch, variant, debug, verbose, 'cmake', nr_jobs,
-                                 generator, cmd_type, config, pkg_cfg[pkg], cmd)
+            create_build_command(pkg, arch, variant, debug, verbose, 'uninstall',
+                                 nr_jobs, generator, cmd_type, config, pkg_cfg, cmd)
             if cmd:
-                if config['os_type'] == 'windows':
-                    env_set = True
-                    setup_environment()
-                    build_cmd_pipe = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.STDOUT)
-                else:
-                    build_cmd_pipe = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.STDOUT, preexec_fn = setup_environment)
-                while True:
-                    line = build_cmd_pipe.stdout.readline()
-                    if not line: break
-                    output(line)
-                    log_fd.write(line)
-                    if build_stop:
-                        break
+                run_package_stage(config, arch, variant, pkg, 'uninstall', cmd, work_path,
+                                  pkg_cfg['env_var'], output)
                 if build_stop:
-                    break
-                build_cmd_pipe.wait()
-                if build_cmd_pipe.returncode:
-                    ret = 'cmake fail for %s! ret code: %d.'%(pkg, build_cmd_pipe.returncode)
-                    break
+                    return
+    except:
+        pass
 
+    try:
+        if configured and (clean == 'uninstall_clean' or clean == 'clean_only'):
             cmd = []
-            create_build_command(pkg, arch, variant, debug, verbose, 'make', nr_jobs,
-                                 generator, cmd_type, config, pkg_cfg[pkg], cmd)
+            create_build_command(pkg, arch, variant, debug, verbose, 'clean',
+                                 nr_jobs, generator, cmd_type, config, pkg_cfg, cmd)
             if cmd:
-                if config['os_type'] == 'windows':
-                    if not env_set:
-                        env_set = True
-                        setup_environment()
-                    build_cmd_pipe = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.STDOUT)
-                else:
-                    build_cmd_pipe = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.STDOUT, preexec_fn = setup_environment)
-                while True:
-                    line = build_cmd_pipe.stdout.readline()
-                    if not line: break
-                    output(line)
-                    log_fd.write(line)
-                    if build_stop:
-                        break
+                run_package_stage(config, arch, variant, pkg, 'clean', cmd, work_path,
+                                  pkg_cfg['env_var'], output)
                 if build_stop:
-                    break
-                build_cmd_pipe.wait()
-                if build_cmd_pipe.returncode:
-                    ret = 'make fail for %s!. ret code: %d.'%(pkg, build_cmd_pipe.returncode)
-                    break
-            if env_set:
-                env_set = False
-                unset_env(pkg_cfg[pkg]['env_var'])
+                    return
+    except:
+        pass
+
+    try:
+        if cmd_type == 'cmake':
+            output(('Removing working directory: %s\n'%(work_path)).encode('utf-8'))
+            move_to_trash(work_path, config)
+    except:
+        pass
+
+def build_package(pkg, arch, variant, debug, verbose, nr_jobs, generator, config, pkg_cfg, output, jobserver = None, worker = None):
+    config_package_path(config, arch, pkg, variant)
+    cmd_type = get_build_cmd_type(pkg, arch, config)
+    if cmd_type == 'cmake':
+        work_path = config['PACKAGES'][arch][pkg]['BuildDir']
+        if not worker and not os.path.exists(work_path):
+            try:
+                os.makedirs(work_path)
+            except:
+                return 'Package %s: cannot create work path %s!'%(pkg, work_path)
+    elif cmd_type == 'make':
+        work_path = config['PACKAGES'][arch][pkg]['Path']
+        if not os.path.exists(work_path):
+            return 'Work path for package %s does not exist!'%(pkg)
+    else:
+        return 'Fail to create build command for package %s! Possibly there is no CMakeList, Makefile or GNUMakefile for the package.'%(pkg)
+    stats_log = setup_compiler_cache(pkg, arch, config, pkg_cfg)
+    if jobserver and cmd_type == 'cmake' and is_ninja_generator(generator, arch, config):
+        if ninja_joins_jobserver():
+            jobserver = dict(jobserver, fifo = True)
+        else:
+            # the jobserver would be ignored: ninja gets the jobs of -j
+            nr_jobs = jobserver['jobs']
+            jobserver = None
+
+    cmake_cmd = []
+    create_build_command(pkg, arch, variant, debug, verbose, 'cmake', nr_jobs,
+                         generator, cmd_type, config, pkg_cfg, cmake_cmd)
+    make_cmd = []
+    create_build_command(pkg, arch, variant, debug, verbose, 'make', nr_jobs,
+                         generator, cmd_type, config, pkg_cfg, make_cmd)
+
+    fingerprint = get_package_fingerprint(pkg, arch, variant, debug, cmd_type, config,
+                                          pkg_cfg, [cmake_cmd, make_cmd])
+    if not config.get('force_build') and fingerprint == read_fingerprint(config, arch, pkg) \
+            and package_is_installed(config, arch, pkg):
+        output(('==== %s is up to date. Skipping...\n'%(pkg)).encode('utf-8'))
+        return 'skip'
+    remove_fingerprint(config, arch, pkg)
+
+    artifact_key = None
+    if config.get('artifact_cache', True):
+        # for packages depending on this one even if it is not cached itself
+        artifact_key = get_artifact_key(pkg, arch, variant, debug, cmd_type, config,
+                                        pkg_cfg, [cmake_cmd, make_cmd])
+        if cmd_type == 'cmake' and artifact_key and not config.get('force_build') \
+                and restore_artifact(config, arch, pkg, artifact_key):
+            output(('==== %s is restored from the cache.\n'%(pkg)).encode('utf-8'))
+            write_fingerprint(config, arch, pkg, fingerprint, artifact_key)
+            return 'cached'
+
+    if worker:
+        steps = []
+        if cmake_cmd:
+            steps.append({'name' : 'cmake', 'cmd' : cmake_cmd, 'path' : work_path,
+                          'stamp' : get_configure_stamp(cmake_cmd, pkg, arch, config, pkg_cfg)})
+        if make_cmd:
+            steps.append({'name' : 'make', 'cmd' : make_cmd, 'path' : work_path, 'stamp' : None})
+        stage_dirs = [config['PACKAGES'][arch][pkg]['StageDir']]
+        host_arch = config['os_type']
+        if 'Tools' in config['PACKAGES'][arch][pkg] and arch != host_arch and host_arch in config['private']:
+            stage_dirs.append(get_stage_path(config, host_arch, None))
+        log_fd = open_package_log(config, arch, variant, pkg, 'remote')
+        start = time.time()
+        try:
+            ret = run_remote_build(worker, pkg, steps, pkg_cfg['env_var'], stage_dirs, config, output, log_fd)
+        finally:
+            close_package_log(log_fd)
+            add_trace_event('%s: remote'%(pkg), 'remote', start, time.time(),
+                            {'arch' : arch, 'variant' : variant, 'worker' : worker['address']})
+        if ret['info'] != 'ok':
+            return ret['info']
+        if ret['ret'] is None:
+            return 'break'
+        if ret['ret'] and ret['step'] == 'cmake':
+            return 'cmake fail for %s! ret code: %d.'%(pkg, ret['ret'])
+        if ret['ret']:
+            return 'make fail for %s!. ret code: %d.'%(pkg, ret['ret'])
+        write_fingerprint(config, arch, pkg, fingerprint, artifact_key)
+        return 'ok'
+
+    if stats_log:
+        reset_compiler_cache_stats(stats_log)
+    try:
+        if cmake_cmd:
+            stamp = get_configure_stamp(cmake_cmd, pkg, arch, config, pkg_cfg)
+            if configure_is_up_to_date(work_path, stamp):
+                output(('==== Configuration of %s is up to date. Skipping cmake...\n'%(pkg)).encode('utf-8'))
+            else:
+                write_configure_stamp(work_path, None)
+                drop_stale_cmake_cache(work_path, cmake_cmd)
+                ret_code = run_package_stage(config, arch, variant, pkg, 'cmake', cmake_cmd, work_path,
+                                             pkg_cfg['env_var'], output, jobserver)
+                if ret_code is None:
+                    return 'break'
+                if ret_code:
+                    return 'cmake fail for %s! ret code: %d.'%(pkg, ret_code)
+                write_configure_stamp(work_path, stamp)
+
+        if make_cmd:
+            ret_code = run_package_stage(config, arch, variant, pkg, 'make', make_cmd, work_path,
+                                         pkg_cfg['env_var'], output, jobserver)
+            if ret_code is None:
+                return 'break'
+            if ret_code:
+                return 'make fail for %s!. ret code: %d.'%(pkg, ret_code)
+    finally:
+        if stats_log:
+            compiler_cache_stats[(arch, variant, pkg)] = read_compiler_cache_stats(stats_log)
+
+    if cmd_type == 'make':
+        # in-tree build: take the generated files into account as well; a
+        # daemon still has the tree as it was before the build
+        invalidate_source_cache([work_path])
+        fingerprint = get_package_fingerprint(pkg, arch, variant, debug, cmd_type, config,
+                                              pkg_cfg, [cmake_cmd, make_cmd])
+    if cmd_type == 'cmake' and artifact_key and should_install(config, arch, pkg):
+        store_artifact(config, arch, pkg, artifact_key)
+    write_fingerprint(config, arch, pkg, fingerprint, artifact_key)
+    return 'ok'
+
+def load_package_configs(packages, arch, config):
+    pkg_cfg = {}
+    for pkg in packages:
+        cfg = copy_private_config(config['private'][arch])
+        import_configs(cfg, config['PACKAGES'][arch][pkg])
+        if 'PACKAGES-PER-ARCH' in config and arch in config['PACKAGES-PER-ARCH'] and pkg in config['PACKAGES-PER-ARCH'][arch]:
+            import_configs(cfg, config['PACKAGES-PER-ARCH'][arch][pkg])
+        cfg['env_var'].update(load_env_from_source_file(cfg['env_source_cmd'], config.get('refresh_env'))) 
+        pkg_cfg[pkg] = cfg
+    return pkg_cfg
+
+def get_variant_config(config, arch):
+    # BuildDir and StageDir of a package depend on the variant: every variant
+    # of an arch built at the same time sees packages of its own
+    variant_config = dict(config)
+    variant_config['PACKAGES'] = dict(config['PACKAGES'])
+    variant_config['PACKAGES'][arch] = dict((pkg, PackageInfo(info)) for pkg, info in config['PACKAGES'][arch].items())
+    return variant_config
+
+def do_build_packages(packages, arch, variant, debug, verbose, clean, not_build, nr_jobs, generator, config, output, nr_parallel = 1):
+    # one arch and variant; the result is keyed by package name as before
+    # do_build_matrix() existed
+    if not variant:
+        variant = config['BUILD_VARIANTS'][arch]['DEFAULT_VARIANT']
+    ret = do_build_matrix([(arch, variant, packages)], debug, verbose, clean, not_build, nr_jobs,
+                          generator, config, output, nr_parallel)
+    ret['status'] = dict((job[2], state) for job, state in ret['status'].items())
+    if isinstance(ret['package'], tuple):
+        ret['package'] = ret['package'][2]
+    if 'compiler_cache' in ret:
+        ret['compiler_cache'] = dict((job[2], stats) for job, stats in ret['compiler_cache'].items())
+    return ret
+
+def do_build_matrix(builds, debug, verbose, clean, not_build, nr_jobs, generator, config, output, nr_parallel = 1):
+    # Build the packages of several (arch, variant, packages) in one schedule
+    # sharing one job budget. Jobs are (arch, variant, package); a package
+    # using host tools waits for them when they are built as well.
+    global build_stop
+
+    if not nr_jobs:
+        import multiprocessing
+        nr_jobs = multiprocessing.cpu_count()
+    build_stop = 0
+    if nr_jobs < 1:
+        nr_jobs = 1
+
+    # the same arch and variant given twice is built once
+    pairs = []
+    build_lists = {}
+    for arch, variant, packages in builds:
+        if not (arch, variant) in build_lists:
+            pairs.append((arch, variant))
+            build_lists[(arch, variant)] = []
+        build_list = build_lists[(arch, variant)]
+        for pkg in packages:
+            if pkg != build_all_target and not pkg in build_list:
+                build_list.append(pkg)
+    for arch, variant in pairs:
+        log_base = os.path.join(config['LOG_DIR'], arch, variant)
+        if not os.path.exists(log_base):
+            try:
+                os.makedirs(log_base)
+            except:
+                return {'info' : 'Unable to create log dir %s'%(log_base), 'package' : None, 'status' : {}}
+
+    start = time.time()
+    archs = [arch for arch, variant in pairs]
+    configs = {}
+    jobs = []
+    pkg_cfg = {}
+    for arch, variant in pairs:
+        build_config = config
+        if archs.count(arch) > 1:
+            build_config = get_variant_config(config, arch)
+        configs[(arch, variant)] = build_config
+        cfgs = load_package_configs(build_lists[(arch, variant)], arch, config)
+        for pkg in build_lists[(arch, variant)]:
+            jobs.append((arch, variant, pkg))
+            pkg_cfg[(arch, variant, pkg)] = cfgs[pkg]
+    if pairs:
+        setup_global_build_env(pairs[0][0], config)
+    add_trace_event('prepare %s'%(' '.join(['%s/%s'%(arch, variant) for arch, variant in pairs])), 'plan',
+                    start, time.time(), {'packages' : len(jobs)})
+
+    # a package is built one after the other by the variants sharing its
+    # stage dir, and by all building it in its source tree
+    shared_deps = {}
+    shared_jobs = {}
+    for job in jobs:
+        arch, variant, pkg = job
+        build_config = configs[(arch, variant)]
+        config_package_path(build_config, arch, pkg, variant)
+        shared = [(build_config['PACKAGES'][arch][pkg]['StageDir'], pkg)]
+        if get_build_cmd_type(pkg, arch, build_config) != 'cmake':
+            shared.append(build_config['PACKAGES'][arch][pkg]['Path'])
+        for key in shared:
+            if key in shared_jobs:
+                shared_deps.setdefault(job, set()).add(shared_jobs[key])
+            shared_jobs[key] = job
+
+    def get_job_output(job):
+        if len(pairs) > 1:
+            return get_package_output(output, '%s/%s/%s'%job, config)
+        return get_package_output(output, job[2], config)
+
+    # ==== Clean packages ====
+    status = {}
+    if clean:
+        # packages are cleaned independently of each other, build trees go
+        # to the trash
+        def clean_job(job):
+            arch, variant, pkg = job
+            clean_package(pkg, arch, variant, debug, verbose, clean, nr_jobs, generator,
+                          configs[(arch, variant)], pkg_cfg[job], get_job_output(job))
+            if build_stop:
+                return 'break'
+            return 'ok'
+        ret = schedule_jobs(jobs, shared_deps, nr_jobs, clean_job)
+        status = dict((job, 'done') for job in ret['status'] if ret['status'][job] == 'done')
+        start_trash_reaper(config)
+
+    if not_build:
+        ret = 'ok'
+        if build_stop:
+            ret = 'break'
+        build_stop = 0
+        return {'info' : ret, 'package' : None, 'status' : status}
+
+    # ==== Build packages ====
+    jobserver = None
+    make_jobs = nr_jobs
+    workers = []
+    if config.get('workers'):
+        # every worker builds one package at a time with its own number of jobs
+        ret = connect_workers(config['workers'])
+        if ret['ret'] != 'ok':
+            return {'info' : ret['info'], 'package' : None, 'status' : status}
+        workers = ret['workers']
+        nr_parallel = len(workers)
+    elif [arch for arch in archs if get_generator_id(generator, arch, config) != 'nmake']:
+        jobserver = create_jobserver(nr_jobs, config)
+        if jobserver:
+            make_jobs = 0
+    idle_workers = list(workers)
+    workers_lock = threading.Lock()
+
+    started = {}
+    def build_job(job):
+        arch, variant, pkg = job
+        package_output = get_job_output(job)
+        if workers:
+            # never empty: no more jobs run at the same time than there are workers
+            with workers_lock:
+                worker = idle_workers.pop()
+            started[job] = time.time()
+            try:
+                return build_package(pkg, arch, variant, debug, verbose, worker['jobs'], generator,
+                                     configs[(arch, variant)], pkg_cfg[job], package_output, None, worker)
+            finally:
+                with workers_lock:
+                    idle_workers.append(worker)
+        token = jobserver_acquire(jobserver)
+        # waiting for a token is not part of the build time
+        started[job] = time.time()
+        try:
+            return build_package(pkg, arch, variant, debug, verbose, make_jobs, generator,
+                                 configs[(arch, variant)], pkg_cfg[job], package_output, jobserver)
+        finally:
+            jobserver_release(jobserver, token)
+
+    progress = {'done' : 0}
+    busy_lanes = set()
+    durations = dict((pair, {}) for pair in pairs)
+    def run_job(job):
+        arch, variant, pkg = job
+        # every running job gets the lowest free lane of the trace
+        with workers_lock:
+            lane = 1
+            while lane in busy_lanes:
+                lane += 1
+            busy_lanes.add(lane)
+        set_trace_lane(lane)
+        # a failure before the first stage log is opened has no log, not the
+        # one of the clean before
+        package_logs.pop(job, None)
+        result = 'Fail running command!'
+        try:
+            result = build_job(job)
+            return result
+        finally:
+            end = time.time()
+            start = started.pop(job, end)
+            add_trace_event(pkg, 'package', start, end, {'arch' : arch, 'variant' : variant, 'status' : result})
+            set_trace_lane(0)
+            with workers_lock:
+                busy_lanes.discard(lane)
+                # skipped and cached packages say nothing about the build time
+                if result == 'ok':
+                    durations[(arch, variant)][pkg] = round(end - start, 3)
+                if config.get('quiet'):
+                    progress['done'] += 1
+                    state = {'ok' : 'done', 'skip' : 'up to date', 'cached' : 'restored from cache',
+                             'break' : 'stopped'}.get(result, 'FAILED')
+                    name = len(pairs) > 1 and '%s/%s/%s'%job or pkg
+                    output(('[%d/%d] %s: %s (%.1fs)\n'%(progress['done'], len(jobs), name, state,
+                                                        end - start)).encode('utf-8'))
+
+    deps = {}
+    priority = None
+    if nr_parallel > 1:
+        history = {}
+        host_arch = config['os_type']
+        tools_variant = None
+        if host_arch in config['BUILD_VARIANTS']:
+            tools_variant = config['BUILD_VARIANTS'][host_arch]['DEFAULT_VARIANT']
+        for arch, variant in pairs:
+            build_list = build_lists[(arch, variant)]
+            graph = config['BUILD_VARIANTS'][arch]['VARIANTS'][variant]['GRAPH']
+            for pkg, pkg_deps in get_package_dependencies(graph, build_list).items():
+                deps[(arch, variant, pkg)] = set([(arch, variant, dep) for dep in pkg_deps])
+            for pkg, duration in read_build_history(config, arch, variant).items():
+                history[(arch, variant, pkg)] = duration
+            for pkg in build_list:
+                job = (arch, variant, pkg)
+                deps.setdefault(job, set()).update(shared_deps.get(job, ()))
+                if 'Tools' in config['PACKAGES'][arch][pkg]:
+                    for tool in config['PACKAGES'][arch][pkg]['Tools']:
+                        tool_job = (host_arch, tools_variant, tool)
+                        if tool_job in pkg_cfg and tool_job != job:
+                            deps[job].add(tool_job)
+        priority = get_critical_path_priority(jobs, deps, history)
+    try:
+        ret = schedule_jobs(jobs, deps, nr_parallel, run_job, priority)
     except BaseException as e:
         print(e)
-        if not build_stop:
-            ret = 'Fail running command!'
-    if log_fd:
-        log_fd.close()
+        ret = {'info' : 'Fail running command!', 'package' : '', 'status' : {}}
+    for arch, variant in pairs:
+        write_build_history(config, arch, variant, durations[(arch, variant)])
+    close_jobserver(jobserver)
+    disconnect_workers(workers)
+    if not isinstance(ret['package'], tuple):
+        ret['package'] = ''
+    if ret['info'] != 'ok' and ret['package'] in package_logs:
+        ret['log'] = package_logs[ret['package']]
+        if config.get('quiet') and ret['info'] != 'break':
+            output(('==== Last %d lines of %s:\n'%(config.get('tail', 30), ret['log'])).encode('utf-8'))
+            output(read_log_tail(ret['log'], config.get('tail', 30)))
+    ret['compiler_cache'] = dict((job, compiler_cache_stats[job]) for job in jobs if job in compiler_cache_stats)
     if build_stop:
-        ret = 'break'
+        ret['info'] = 'break'
     build_stop = 0
-    if env_set:
-        env_set = False
-        unset_env(pkg_cfg[cur_package]['env_var'])
-    return {'info' : ret, 'package' : cur_package}
-
-def guess_current_package(current_dir, config, arch):
-    max_len = 0
-    candidate_pkg = None
-    candidate_base = None
+    return ret
+
+def ninja_escape(text):
+    return text.replace('$', '$$').replace('\n', '$\n')
+
+def ninja_escape_path(path):
+    return ninja_escape(path).replace(' ', '$ ').replace(':', '$:')
+
+def get_ninja_inputs(path, excludes):
+    # every file and directory of the source tree: a new or removed file
+    # changes the time of its directory
+    inputs = []
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted([d for d in dirs if not d in ('.git', '.svn', '.repo')
+                          and not os.path.join(root, d) in excludes])
+        inputs.append(root)
+        inputs += [os.path.join(root, name) for name in sorted(files)]
+    return inputs
+
+def export_ninja(ninja_file, builds, debug, verbose, nr_jobs, nr_parallel, generator, config, regen_cmd = None, regen_dir = None):
+    # One Ninja file for the packages of builds, a list of (arch, variant,
+    # packages in build order). Every package has configure (cmake only),
+    # build and install steps ending in a stamp file; a package is configured
+    # once the packages it depends on are installed and built again whenever one
+    # of them is installed again. Fingerprints, the binary cache and the logs of
+    # buildCentral are not used by the exported build.
+    quote = getattr(shlex, 'quote', None)
+    if not quote:
+        import pipes
+        quote = pipes.quote
+    if not nr_jobs:
+        import multiprocessing
+        nr_jobs = multiprocessing.cpu_count()
+    environ = dict(os.environ)
+    stamp_dir = os.path.join(os.path.dirname(os.path.abspath(ninja_file)), '.bc-stamps')
+    lines = ['# generated by buildCentral; changes are lost when it is exported again',
+             'ninja_required_version = 1.5',
+             '',
+             'pool packages',
+             '  depth = %d'%(max(nr_parallel, 1)),
+             '',
+             'rule step',
+             '  command = $cmd',
+             '  description = $desc',
+             '  pool = packages',
+             # the stamp is newer than the files an in-tree build writes
+             '  restat = 1',
+             '']
+    installed = {}
+    nr_steps = 0
+    for arch, variant, packages in builds:
+        if get_generator_id(generator, arch, config) == 'nmake' or 'Visual Studio' in check_generator(generator, arch, config):
+            return {'ret' : 'Error! Ninja files can not be exported for generator %s!'%(check_generator(generator, arch, config))}
+        pkg_cfg = load_package_configs(packages, arch, config)
+        setup_global_build_env(arch, config)
+        graph = config['BUILD_VARIANTS'][arch]['VARIANTS'][variant]['GRAPH']
+        deps = get_package_dependencies(graph, packages)
+        host_arch = config['os_type']
+        for pkg in packages:
+            config_package_path(config, arch, pkg, variant)
+            pkg_info = config['PACKAGES'][arch][pkg]
+            cmd_type = get_build_cmd_type(pkg, arch, config)
+            if cmd_type == 'cmake':
+                work_path = pkg_info['BuildDir']
+            elif cmd_type == 'make':
+                work_path = pkg_info['Path']
+            else:
+                return {'ret' : 'Fail to create build command for package %s! Possibly there is no CMakeList, Makefile or GNUMakefile for the package.'%(pkg)}
+            setup_compiler_cache(pkg, arch, config, pkg_cfg[pkg])
+            cmake_cmd = []
+            create_build_command(pkg, arch, variant, debug, verbose, 'cmake', nr_jobs,
+                                 generator, cmd_type, config, pkg_cfg[pkg], cmake_cmd)
+            make_cmd = []
+            create_build_command(pkg, arch, variant, debug, verbose, 'make', nr_jobs,
+                                 generator, cmd_type, config, pkg_cfg[pkg], make_cmd)
+
+            # only what differs from the environment ninja is started in
+            env = get_build_env(pkg_cfg[pkg]['env_var'])
+            env_prefix = ' '.join([quote('%s=%s'%(name, env[name])) for name in sorted(env)
+                                   if environ.get(name) != env[name] and not name in ('_', 'PWD', 'OLDPWD', 'SHLVL')])
+            if env_prefix:
+                env_prefix = 'env ' + env_prefix + ' '
+
+            name = '%s/%s/%s'%(arch, variant, pkg)
+            stamp = os.path.join(stamp_dir, arch, variant, pkg)
+            after = [installed[(arch, dep)] for dep in sorted(deps.get(pkg, ())) if (arch, dep) in installed]
+            if 'Tools' in pkg_info:
+                after += [installed[(host_arch, tool)] for tool in sorted(pkg_info['Tools'])
+                          if (host_arch, tool) in installed and (host_arch, tool) != (arch, pkg)]
+            inputs = get_ninja_inputs(pkg_info['Path'], set([pkg_info['BuildDir'], config['OUTPUT_DIR']]))
+
+            steps = []
+            if cmd_type == 'cmake':
+                build_cmd = []
+                create_build_command(pkg, arch, variant, debug, verbose, 'build', nr_jobs,
+                                     generator, cmd_type, config, pkg_cfg[pkg], build_cmd)
+                # the build tool runs cmake again itself when a CMakeLists.txt changes;
+                # installed dependencies only need to exist when configuring, but a
+                # reinstalled one must build the package again
+                steps.append(('configure', cmake_cmd, [], [], after))
+                steps.append(('build', build_cmd, inputs, after, []))
+                if pkg_info['MakeTarget']:
+                    steps.append(('install', make_cmd, [], [], []))
+            else:
+                steps.append(('build', make_cmd, inputs, after, []))
+
+            previous = []
+            for step, cmd, step_inputs, implicit, order in steps:
+                output = stamp + '.' + step
+                command = 'mkdir -p %s && cd %s && %s%s && touch %s'%(
+                    quote(work_path), quote(work_path), env_prefix, ' '.join([quote(c) for c in cmd]), quote(output))
+                lines.append('build %s: step %s%s%s'%(ninja_escape_path(output),
+                    ' '.join([ninja_escape_path(p) for p in previous + step_inputs]),
+                    implicit and ' | ' + ' '.join([ninja_escape_path(p) for p in implicit]) or '',
+                    order and ' || ' + ' '.join([ninja_escape_path(p) for p in order]) or ''))
+                lines.append('  cmd = %s'%(ninja_escape(command)))
+                lines.append('  desc = %s %s'%(step, name))
+                lines.append('')
+                previous = [output]
+                nr_steps += 1
+            installed[(arch, pkg)] = previous[0]
+            lines.append('build %s: phony %s'%(ninja_escape_path(name), ninja_escape_path(previous[0])))
+            lines.append('')
+
+    lines.append('build all: phony %s'%(' '.join([ninja_escape_path(installed[key]) for key in sorted(installed)])))
+    lines.append('default all')
+    lines.append('')
+    if regen_cmd:
+        cfg_files = [get_config_file(None, config['proj_root'])]
+        cfg_files += [f for f in get_private_config_files(config['proj_root']) if os.path.exists(f)]
+        lines += ['rule regen',
+                  '  command = cd %s && %s'%(ninja_escape(quote(regen_dir or os.getcwd())),
+                                             ninja_escape(' '.join([quote(c) for c in regen_cmd]))),
+                  '  description = export %s again'%(ninja_escape(os.path.basename(ninja_file))),
+                  '  generator = 1',
+                  '',
+                  # ninja knows its manifest by the name it was started with
+                  'build %s: regen %s'%(ninja_escape_path(os.path.basename(ninja_file)),
+                                        ' '.join([ninja_escape_path(f) for f in cfg_files])),
+                  '']
+    try:
+        if not os.path.isdir(os.path.dirname(os.path.abspath(ninja_file))):
+            os.makedirs(os.path.dirname(os.path.abspath(ninja_file)))
+        fd = open(ninja_file + '.%d.tmp'%(os.getpid()), 'w')
+        fd.write('\n'.join(lines))
+        fd.close()
+        os.rename(ninja_file + '.%d.tmp'%(os.getpid()), ninja_file)
+    except (IOError, OSError) as e:
+        return {'ret' : 'Unable to write %s: %s'%(ninja_file, str(e))}
+    return {'ret' : 'ok', 'steps' : nr_steps}
+
+def get_package_path_index(config, arch):
+    # A trie of path components, built once per config and arch; a node
+    # holds the packages whose Path ends there and the nodes below it.
+    indexes = config.setdefault('path_index', {})
+    if arch in indexes:
+        return indexes[arch]
+    root = {'packages' : [], 'next' : {}, 'paths' : {}}
     for pkg in config['PACKAGES'][arch]:
-        pkg_base = config['PACKAGES'][arch][pkg]['Path']
-        if current_dir.find(pkg_base) == 0:
-            if len(pkg_base) > max_len:
-                max_len = len(pkg_base)
-                candidate_pkg = pkg
-                candidate_base = pkg_base
-
-    cur_pkg = []
-    if candidate_pkg:
-        for pkg in config['PACKAGES'][arch]:
-            if candidate_base == config['PACKAGES'][arch][pkg]['Path']:
-                cur_pkg.append(pkg)
+        # Path is relative to the project root until the package is built
+        pkg_base = os.path.normpath(os.path.join(config['proj_root'], config['PACKAGES'][arch][pkg]['Path']))
+        node = root
+        for name in pkg_base.split(os.sep):
+            if name:
+                node = node['next'].setdefault(name, {'packages' : [], 'next' : {}})
+        node['packages'].append(pkg)
+        root['paths'].setdefault(pkg_base, node['packages'])
+    indexes[arch] = root
+    return root
+
+def lookup_package_path_index(index, path):
+    # packages of the deepest Path containing path
+    packages = index['packages']
+    node = index
+    for name in os.path.normpath(path).split(os.sep):
+        if not name:
+            continue
+        node = node['next'].get(name)
+        if node is None:
+            break
+        if node['packages']:
+            packages = node['packages']
+    return packages
+
+def get_packages_by_path(path, config, arch):
+    return list(lookup_package_path_index(get_package_path_index(config, arch), path))
+
+def get_packages_by_files(files, config, arch):
+    # many files share a directory: look every directory up once
+    index = get_package_path_index(config, arch)
+    dirs = {}
+    packages = set()
+    for f in files:
+        f = os.path.normpath(f)
+        # unless the file is the Path of a package itself
+        if f in index['paths']:
+            packages.update(index['paths'][f])
+            continue
+        path = os.path.dirname(f)
+        if not path in dirs:
+            dirs[path] = lookup_package_path_index(index, path)
+        packages.update(dirs[path])
+    return packages
+
+# inotify(7) masks; a changed file is written, moved or removed
+inotify_mask = 0x8 | 0x40 | 0x80 | 0x100 | 0x200       # CLOSE_WRITE MOVED_FROM MOVED_TO CREATE DELETE
+inotify_isdir = 0x40000000
+inotify_overflow = 0x4000
+
+def get_watch_dirs(path, excludes):
+    dirs = []
+    for root, subdirs, files in os.walk(path):
+        subdirs[:] = [d for d in subdirs if not d in ('.git', '.svn', '.repo')
+                      and not os.path.join(root, d) in excludes]
+        dirs.append(root)
+    return dirs
+
+def add_inotify_watch(watcher, path):
+    for d in get_watch_dirs(path, watcher['excludes']):
+        wd = watcher['libc'].inotify_add_watch(watcher['fd'], d.encode('utf-8'), inotify_mask)
+        if wd >= 0:
+            watcher['dirs'][wd] = d
+        else:
+            # out of watches (fs.inotify.max_user_watches): changes may be missed
+            watcher['complete'] = False
+
+def scan_watch_files(watcher):
+    files = {}
+    for path in watcher['paths']:
+        if os.path.isfile(path):
+            st = os.stat(path)
+            files[path] = (st.st_size, st.st_mtime_ns)
+            continue
+        for d in get_watch_dirs(path, watcher['excludes']):
+            try:
+                names = os.listdir(d)
+            except OSError:
+                continue
+            for name in names:
+                file_path = os.path.join(d, name)
+                try:
+                    st = os.lstat(file_path)
+                except OSError:
+                    continue
+                if not os.path.isdir(file_path):
+                    files[file_path] = (st.st_size, st.st_mtime_ns)
+    return files
+
+def create_file_watcher(paths, excludes, poll = False):
+    # inotify on Linux; elsewhere, or with poll, the trees are scanned once a second
+    watcher = {'paths' : paths, 'excludes' : excludes, 'fd' : None, 'dirs' : {}, 'complete' : True}
+    if not poll and sys.platform.startswith('linux'):
+        try:
+            import ctypes
+            libc = ctypes.CDLL(None, use_errno = True)
+            fd = libc.inotify_init1(os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            fd = -1
+        if fd >= 0:
+            watcher['libc'] = libc
+            watcher['fd'] = fd
+            for path in paths:
+                add_inotify_watch(watcher, path)
+            return watcher
+    watcher['files'] = scan_watch_files(watcher)
+    return watcher
+
+def read_inotify_events(watcher, changed):
+    import struct
+    data = os.read(watcher['fd'], 65536)
+    pos = 0
+    while pos + 16 <= len(data):
+        wd, mask, cookie, length = struct.unpack('iIII', data[pos:pos + 16])
+        name = data[pos + 16:pos + 16 + length].rstrip(b'\0').decode('utf-8', 'replace')
+        pos += 16 + length
+        if mask & inotify_overflow:
+            # events were lost: everything may have changed
+            changed.update(watcher['paths'])
+            continue
+        if not wd in watcher['dirs']:
+            continue
+        path = os.path.join(watcher['dirs'][wd], name)
+        if mask & inotify_isdir:
+            if mask & (0x80 | 0x100) and not path in watcher['excludes']:
+                add_inotify_watch(watcher, path)
+                changed.add(path)
+                # files created before the watch was added
+                for d in get_watch_dirs(path, watcher['excludes']):
+                    try:
+                        changed.update([os.path.join(d, name) for name in os.listdir(d)])
+                    except OSError:
+                        pass
+            continue
+        changed.add(path)
+
+def wait_file_changes(watcher, debounce = 0.3):
+    # Block until something changed, then wait until nothing changes for
+    # debounce seconds so that a whole save or checkout is handled at once.
+    changed = set()
+    if watcher['fd'] is not None:
+        timeout = None
+        while True:
+            readable = select.select([watcher['fd']], [], [], timeout)[0]
+            if not readable:
+                if changed:
+                    return sorted(changed)
+                continue
+            read_inotify_events(watcher, changed)
+            if changed:
+                timeout = debounce
+    while True:
+        time.sleep(changed and debounce or 1.0)
+        files = scan_watch_files(watcher)
+        diff = set([f for f in files if watcher['files'].get(f) != files[f]])
+        diff |= set([f for f in watcher['files'] if not f in files])
+        watcher['files'] = files
+        if not diff and changed:
+            return sorted(changed)
+        changed |= diff
+
+def get_file_changes(watcher):
+    # changes so far, without waiting
+    changed = set()
+    if watcher['fd'] is not None:
+        while select.select([watcher['fd']], [], [], 0)[0]:
+            read_inotify_events(watcher, changed)
     else:
+        files = scan_watch_files(watcher)
+        changed = set([f for f in files if watcher['files'].get(f) != files[f]])
+        changed |= set([f for f in watcher['files'] if not f in files])
+        watcher['files'] = files
+    return sorted(changed)
+
+def close_file_watcher(watcher):
+    if watcher['fd'] is not None:
+        os.close(watcher['fd'])
+        watcher['fd'] = None
+
+def guess_current_package(current_dir, config, arch):
+    cur_pkg = get_packages_by_path(current_dir, config, arch)
+    if not cur_pkg:
         if current_dir.find(config['proj_root']) == 0:
             cur_pkg.append(build_all_target)
 
     return cur_pkg
 
+def get_changed_files(change_set, current_dir):
+    # change_set is a git revision range ('origin/master..HEAD'), a single
+    # revision (compared with the work tree) or files separated by ','
+    is_revision = change_set.find('..') >= 0
+    if not is_revision:
+        try:
+            is_revision = not sp.call(['git', 'rev-parse', '--verify', '-q', change_set + '^{commit}'],
+                                      stdout = sp.PIPE, stderr = sp.PIPE, cwd = current_dir)
+        except OSError:
+            is_revision = False
+    if not is_revision:
+        return {'ret' : 'ok', 'files' : [os.path.abspath(os.path.join(current_dir, f))
+                                         for f in change_set.split(',') if f]}
+    try:
+        top_dir = sp.check_output(['git', 'rev-parse', '--show-toplevel'], stderr = sp.PIPE,
+                                  cwd = current_dir).decode('utf-8').strip()
+        names = sp.check_output(['git', 'diff', '--name-only', change_set, '--'], stderr = sp.PIPE,
+                                cwd = current_dir).decode('utf-8')
+    except (OSError, sp.CalledProcessError) as e:
+        return {'ret' : 'Unable to get changed files of %s: %s'%(change_set, str(e))}
+    return {'ret' : 'ok', 'files' : [os.path.normpath(os.path.join(top_dir, name))
+                                     for name in names.splitlines() if name]}
+
+def get_affected_packages(files, config, arch, graphs):
+    # packages containing the files plus every package depending on them,
+    # directly or not
+    graph = get_merged_graph(graphs)
+    users = {}
+    for pkg in graph:
+        if pkg == build_all_target:
+            continue
+        for dep in graph[pkg]:
+            users.setdefault(dep, []).append(pkg)
+
+    changed = set([pkg for pkg in get_packages_by_files(files, config, arch) if pkg in graph])
+    affected = set(changed)
+    work = list(changed)
+    while work:
+        for user in users.get(work.pop(), ()):
+            if not user in affected:
+                affected.add(user)
+                work.append(user)
+    return {'changed' : sorted(changed), 'affected' : sorted(affected)}
+
 def get_install_list(arch, package, config, variant):
     if not package in config['PACKAGES'][arch]:
         return {'info' : 'noexist'}
@@ -1054,9 +3281,11 @@ def get_install_list(arch, package, config, variant):
         return {'info' : 'ok', 'files' : file_list}
 
 def draw_graphic(graphs):
+    import networkx as nx
     import matplotlib.pyplot as plt
     graph_id = 0
     for graph in graphs:
+        graph = nx.DiGraph(dict((pkg, list(graph[pkg])) for pkg in graph))
         graph.remove_node(build_all_target)
         plt.figure(figsize=(48,27))
         nx.draw_circular(graph, with_labels=True, edge_color='b', node_color='r', node_size=1000, alpha=0.8)
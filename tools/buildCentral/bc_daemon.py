@@ -0,0 +1,221 @@
+#!/usr/bin/python
+
+"""
+/*
+ * Copyright (C) 2015   Jeremy Chen jeremy_cz@yahoo.com
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *      http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+"""
+
+# Build daemon for one project. mk finds it by the project root and hands it
+# the command line, the current directory and the environment; the daemon
+# keeps the config, the environments of ENV_SOURCE_CMD and what it knows
+# about the source trees between commands. Commands run one after the other.
+
+import os
+import sys
+import signal
+import socket
+import argparse
+import threading
+import traceback
+import bc_core as bcc
+import build_central
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+parser = argparse.ArgumentParser(description='buildCentral build daemon')
+parser.add_argument('-r', '--root', help='project root; guessed from the current directory by default', default=None)
+
+class ClientOutput(object):
+    # sys.stdout and sys.stderr while a command runs; build output comes as
+    # bytes through .buffer and is flushed right away, text is sent in blocks
+    def __init__(self, wfile, command):
+        self.wfile = wfile
+        self.command = command
+        self.buffer = self
+        self.data = []
+        self.size = 0
+
+    def write(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        with self.command['lock']:
+            self.data.append(data)
+            self.size += len(data)
+        if self.size >= 65536:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        with self.command['lock']:
+            data = b''.join(self.data)
+            self.data = []
+            self.size = 0
+            if not data or not self.command['running']:
+                return
+            try:
+                bcc.send_message(self.wfile, {'type' : 'output', 'data' : data.decode('latin-1')})
+            except (IOError, OSError, ValueError):
+                # mk went away: stop the build
+                bcc.build_stop = 1
+
+    def isatty(self):
+        return False
+
+watch = {'key' : None, 'watcher' : None}
+
+def update_source_cache(proj_root):
+    # watch the trees of all packages; rebuilt whenever the config changes
+    cfg_file = bcc.get_config_file(None, proj_root)
+    key = bcc.get_config_cache_key(cfg_file, proj_root)
+    watcher = watch['watcher']
+    if key != watch['key']:
+        if watcher:
+            bcc.close_file_watcher(watcher)
+            watch['watcher'] = watcher = None
+        bcc.source_cache = None
+        config = bcc.load_build_config(None, proj_root)
+        if config['ret'] != 'ok':
+            return
+        paths = set()
+        for arch in config['PACKAGES']:
+            for pkg in config['PACKAGES'][arch]:
+                paths.add(os.path.normpath(os.path.join(proj_root, config['PACKAGES'][arch][pkg]['Path'])))
+        watcher = bcc.create_file_watcher(sorted(paths), set([config['OUTPUT_DIR']]))
+        watch['key'] = key
+        if watcher['fd'] is None or not watcher['complete']:
+            # scanning the trees costs as much as hashing them
+            bcc.close_file_watcher(watcher)
+            print('Source trees are not watched; fingerprints are computed for every command')
+            return
+        watch['watcher'] = watcher
+        bcc.source_cache = {}
+        return
+    if watcher:
+        changed = bcc.get_file_changes(watcher)
+        if set(changed) & set(watcher['paths']):
+            # events were lost
+            bcc.source_cache.clear()
+        bcc.invalidate_source_cache(changed)
+
+def run_command(msg, rfile, wfile):
+    command = {'running' : True, 'lock' : threading.Lock()}
+
+    def read_stop():
+        # 'stop' when Ctrl-C is pressed in mk; nothing when mk went away
+        while True:
+            try:
+                stop = bcc.receive_message(rfile)
+            except (IOError, OSError, ValueError):
+                stop = None
+            with command['lock']:
+                if command['running'] and (stop is None or stop['type'] == 'stop'):
+                    bcc.build_stop = 1
+            if stop is None:
+                break
+
+    reader = threading.Thread(target = read_stop)
+    reader.daemon = True
+    reader.start()
+
+    environ = dict(os.environ)
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = sys.stderr = ClientOutput(wfile, command)
+    code = -1
+    try:
+        os.chdir(msg['cwd'])
+        os.environ.clear()
+        os.environ.update(msg['env'])
+        update_source_cache(args.root)
+        bcc.reset_build_state()
+        build_central.parser.prog = msg.get('prog', 'mk')
+        code = build_central.main(msg['argv'])
+    except SystemExit as e:
+        # argparse exits for -h and bad arguments
+        code = e.code
+        if not isinstance(code, int):
+            code = code is not None and -1 or 0
+    except Exception:
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stdout, sys.stderr = stdout, stderr
+        os.environ.clear()
+        os.environ.update(environ)
+        os.chdir(args.root)
+        with command['lock']:
+            command['running'] = False
+    bcc.send_message(wfile, {'type' : 'exit', 'code' : code})
+
+class DaemonHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            msg = bcc.receive_message(self.rfile)
+            if msg is None or msg['type'] != 'run':
+                return
+            if msg.get('version') != bcc.worker_protocol_version:
+                bcc.send_message(self.wfile, {'type' : 'output', 'data' : 'Build daemon of another version, run mk with --no-daemon!\n'})
+                bcc.send_message(self.wfile, {'type' : 'exit', 'code' : -1})
+                return
+            print('Running mk %s in %s'%(' '.join(msg['argv']), msg['cwd']))
+            sys.stdout.flush()
+            run_command(msg, self.rfile, self.wfile)
+        except (IOError, OSError, ValueError) as e:
+            print('Connection closed: %s'%(str(e)))
+
+class UnixDaemon(socketserver.UnixStreamServer):
+    pass
+
+def stop_daemon(signum, frame):
+    raise KeyboardInterrupt()
+
+args = parser.parse_args()
+if not hasattr(socket, 'AF_UNIX'):
+    print('The build daemon needs unix sockets!')
+    exit(-1)
+if not args.root:
+    args.root = bcc.guess_project_root()
+args.root = os.path.abspath(args.root)
+os.chdir(args.root)
+
+daemon_socket = bcc.get_daemon_socket(args.root)
+if os.path.exists(daemon_socket):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(daemon_socket)
+        print('A build daemon is already running on %s'%(daemon_socket))
+        exit(-1)
+    except (IOError, OSError):
+        os.remove(daemon_socket)
+    finally:
+        sock.close()
+if not os.path.exists(os.path.dirname(daemon_socket)):
+    os.makedirs(os.path.dirname(daemon_socket))
+
+server = UnixDaemon(daemon_socket, DaemonHandler)
+update_source_cache(args.root)
+signal.signal(signal.SIGTERM, stop_daemon)
+print('Build daemon for %s listening on %s'%(args.root, daemon_socket))
+sys.stdout.flush()
+try:
+    server.serve_forever()
+except KeyboardInterrupt:
+    pass
+server.server_close()
+if os.path.exists(daemon_socket):
+    os.remove(daemon_socket)
@@ -0,0 +1,169 @@
+#!/usr/bin/python
+
+"""
+/*
+ * Copyright (C) 2015   Jeremy Chen jeremy_cz@yahoo.com
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *      http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+"""
+
+# Build worker for 'mk --workers'. The project has to be checked out at the
+# same path as on the machine running mk; commands, environment and stage
+# files come from mk, output, exit status and installed files go back. Only
+# clients proving they know BC_WORKER_SECRET are served.
+
+import os
+import sys
+import hmac
+import hashlib
+import socket
+import platform
+import argparse
+import multiprocessing
+import subprocess as sp
+import bc_core as bcc
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+parser = argparse.ArgumentParser(description='buildCentral build worker')
+parser.add_argument('-l', '--listen', help='host:port or path of a unix socket to listen on', default='127.0.0.1:7878')
+parser.add_argument('-j', '--jobs', help='number of jobs for make', type=int, default=0)
+
+def get_worker_env(msg):
+    env = dict(os.environ)
+    for var, pathes in [('PATH', msg['tool_path']), ('LD_LIBRARY_PATH', msg['tool_lib'])]:
+        if pathes:
+            if env.get(var):
+                env[var] += os.pathsep + os.pathsep.join(pathes)
+            else:
+                env[var] = os.pathsep.join(pathes)
+    env.update(msg['env'])
+    return env
+
+def send_output(wfile, line):
+    # latin-1 maps every byte to a character, the output is passed on unchanged
+    bcc.send_message(wfile, {'type' : 'output', 'data' : line.decode('latin-1')})
+
+def run_step(step, env, wfile):
+    try:
+        pipe = sp.Popen(step['cmd'], stdout=sp.PIPE, stderr=sp.STDOUT, cwd = step['path'], env = env)
+    except OSError as e:
+        send_output(wfile, ('%s: %s\n'%(' '.join(step['cmd']), str(e))).encode('utf-8'))
+        return 127
+    try:
+        while True:
+            line = pipe.stdout.readline()
+            if not line: break
+            send_output(wfile, line)
+    except (OSError, ValueError):
+        # mk went away: stop the build
+        pipe.terminate()
+        pipe.wait()
+        raise
+    pipe.wait()
+    return pipe.returncode
+
+def build(msg, wfile):
+    for stage in msg['stage']:
+        bcc.unpack_stage_files(stage['dir'], stage['data'])
+    installed = bcc.scan_stage_dir(msg['stage_dir'])
+    env = get_worker_env(msg)
+
+    for step in msg['steps']:
+        if not os.path.exists(step['path']):
+            try:
+                os.makedirs(step['path'])
+            except OSError:
+                send_output(wfile, ('Package %s: cannot create work path %s!\n'%(msg['package'], step['path'])).encode('utf-8'))
+                bcc.send_message(wfile, {'type' : 'result', 'ret' : 1, 'step' : step['name']})
+                return
+        if step['stamp']:
+            if bcc.configure_is_up_to_date(step['path'], step['stamp']):
+                send_output(wfile, ('==== Configuration of %s is up to date. Skipping cmake...\n'%(msg['package'])).encode('utf-8'))
+                continue
+            bcc.write_configure_stamp(step['path'], None)
+            bcc.drop_stale_cmake_cache(step['path'], step['cmd'])
+        ret_code = run_step(step, env, wfile)
+        if ret_code:
+            bcc.send_message(wfile, {'type' : 'result', 'ret' : ret_code, 'step' : step['name']})
+            return
+        if step['stamp']:
+            bcc.write_configure_stamp(step['path'], step['stamp'])
+
+    files = bcc.scan_stage_dir(msg['stage_dir'])
+    changed = [name for name in files if installed.get(name) != files[name]]
+    stage = None
+    if changed:
+        stage = bcc.pack_stage_files(msg['stage_dir'], changed)
+    bcc.send_message(wfile, {'type' : 'result', 'ret' : 0, 'step' : None, 'stage' : stage})
+
+class WorkerHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        peer = self.client_address or 'local'
+        try:
+            challenge = hashlib.sha1(os.urandom(32)).hexdigest()
+            bcc.send_message(self.wfile, {'type' : 'hello', 'version' : bcc.worker_protocol_version,
+                                          'jobs' : args.jobs, 'host' : platform.node(), 'challenge' : challenge})
+            msg = bcc.receive_message(self.rfile)
+            if not msg or msg.get('type') != 'auth' or \
+                    not hmac.compare_digest(str(msg.get('digest')), bcc.sign_worker_challenge(secret, challenge)):
+                print('Refused %s: wrong secret'%(str(peer)))
+                bcc.send_message(self.wfile, {'type' : 'error', 'info' : 'wrong secret'})
+                return
+            bcc.send_message(self.wfile, {'type' : 'ready'})
+            while True:
+                msg = bcc.receive_message(self.rfile)
+                if msg is None:
+                    break
+                if msg['type'] == 'build':
+                    print('Building %s for %s'%(msg['package'], str(peer)))
+                    build(msg, self.wfile)
+        except (OSError, ValueError) as e:
+            print('Connection from %s: %s'%(str(peer), str(e)))
+
+class TCPWorker(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+if hasattr(socket, 'AF_UNIX'):
+    class UnixWorker(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+args = parser.parse_args()
+secret = bcc.get_worker_secret()
+if not secret:
+    print('BC_WORKER_SECRET is not set! Set it to the same secret for bc_worker.py and mk.')
+    sys.exit(1)
+if not args.jobs:
+    args.jobs = multiprocessing.cpu_count()
+
+family, address = bcc.parse_worker_address(args.listen)
+if family == socket.AF_INET:
+    server = TCPWorker(address, WorkerHandler)
+else:
+    if os.path.exists(address):
+        os.remove(address)
+    server = UnixWorker(address, WorkerHandler)
+print('Worker listening on %s with %d jobs'%(args.listen, args.jobs))
+sys.stdout.flush()
+try:
+    server.serve_forever()
+except KeyboardInterrupt:
+    pass
+server.server_close()
+if family != socket.AF_INET and os.path.exists(address):
+    os.remove(address)
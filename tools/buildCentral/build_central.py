@@ -23,69 +23,41 @@ import bc_core as bcc
 import argparse
 import sys
 import pprint
+import time
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-v', '--verbose', help='run with verbose', action='store_true')
+parser.add_argument('-q', '--quiet', help='show progress only, and the end of the log of a failed package', action='store_true')
+parser.add_argument('--tail', help='number of log lines shown for a failed package with -q', type=int, default=30)
 parser.add_argument('-d', '--debug', help='build debug version', action='store_true')
 parser.add_argument('-c', '--clean', help='clean', action='store_true')
 parser.add_argument('-b', '--clean_build', help='always go along with -c: -cb means clean followed by build', action='store_true')
 parser.add_argument('-l', '--list', help='list all packages', action='store_true')
+parser.add_argument('-f', '--force', help='build packages even if they are up to date', action='store_true')
+parser.add_argument('--no-cache', help='do not restore packages from or store them into the binary cache', action='store_true')
 parser.add_argument('-e', '--exclusive', help='packages not specified for build', action='store_true')
-parser.add_argument('-t', '--target_arch', help='specify target arch. Use -l for details', default=None)
-parser.add_argument('-r', '--build_variant', help='specify a group to build. Use -l for details', default=None)
+parser.add_argument('-t', '--target_arch', help='specify target arches separated by ",". Use -l for details', default=None)
+parser.add_argument('-r', '--build_variant', help='specify groups to build separated by ",". Use -l for details', default=None)
 parser.add_argument('-a', '--dep', help='build with dependency', action='store_true')
+parser.add_argument('--no-daemon', help='build in this process even if bc_daemon.py runs for the project', action='store_true')
+parser.add_argument('--export-ninja', help='write a Ninja file building the packages instead of building them', default=None)
+parser.add_argument('--watch', help='keep running and build packages again when their files change', action='store_true')
+parser.add_argument('--affected', help='build packages affected by a change set: a git revision range, a revision or files separated by ","', default=None)
 parser.add_argument('-j', '--jobs', help='Number of jobs for make', type=int, default=0)
+parser.add_argument('-P', '--parallel', help='Number of packages built at the same time', type=int, default=1)
+parser.add_argument('--workers', help='build on workers (bc_worker.py) instead of locally; host:port or unix socket paths separated by ","', default=None)
 parser.add_argument('-g', '--cmake_generator', help='specify a generator for cmake. Use -i for details', default=None)
 parser.add_argument('-D', '--extra_make_var', help='specify extra (c)make variables separated by ","', default=None)
+parser.add_argument('--refresh-env', help='source ENV_SOURCE_CMD again instead of using the cached environment', action='store_true')
 parser.add_argument('-i', '--info', help='show information', action='store_true')
 parser.add_argument('-p', '--plot', help='plot graphic diagram', action='store_true')
 parser.add_argument('packages', help='packages to be built; separated by ","', nargs='?')
 
-def show_info():
-    print('================================================================')
-    print('            Build Central version 1.0.1')
-    print('Supported architectures: ' + ', '.join(build_config['TARGET_LIST']))
-    print('     Supported variants: ' + ','.join(build_config['BUILD_VARIANTS'][target_arch]['VARIANTS']))
-    print('  Building architecture: ' + target_arch)
-    print('       Building variant: ' + build_variant)
-    print('             Stage path: ' + os.path.normpath(bcc.get_stage_path(build_config, target_arch, build_variant)))
-    print('            Output path: ' + os.path.normpath(build_config['OUTPUT_DIR']))
-    print('================================================================')
-
 def show_generator():
     print('=======================CMake Generator==========================')
     pprint.pprint(bcc.cmake_generator)
     print('================================================================')
 
-args = parser.parse_args()
-
-if args.cmake_generator and not args.cmake_generator in bcc.cmake_generator:
-    print('Generator %s is not supported!'%(args.cmake_generator))
-    show_generator();
-    exit(-1)
-
-build_config = bcc.load_build_config(None, None)
-if build_config['ret'] != 'ok':
-    print(build_config['ret'])
-    exit(-1)
-
-if args.extra_make_var:
-    build_config['extra_make_var'] = args.extra_make_var.split(',')
-
-target_arch = args.target_arch
-host_arch = build_config['os_type']
-if not target_arch:
-    target_arch = build_config['DEFAULT_TARGET']
-if target_arch == build_config['HOST']:
-    target_arch = host_arch
-if not target_arch in build_config['TARGET_LIST']:
-    print('Error: invalid target arch: %s'%(args.target_arch))
-    exit(-1)
-
-if not target_arch in build_config['BUILD_VARIANTS']:
-    print('Error: arch %s is not defined in BUILD_VARIANTS tag!'%(target_arch))
-    exit(-1)
-
 def sort_package_list(pkg_list):
     tmp_list = []
     all_target_found = False 
@@ -102,216 +74,394 @@ def sort_package_list(pkg_list):
         tmp_list.append(bcc.build_all_target)
     return tmp_list
 
-build_variant = args.build_variant
-if not build_variant:
-    build_variant = build_config['BUILD_VARIANTS'][target_arch]['DEFAULT_VARIANT']
-if not build_variant in build_config['BUILD_VARIANTS'][target_arch]['VARIANTS']:
-    print('Error: variant %s is invalid!'%(build_variant))
-    print('Available variant for arch %s: %s'%(target_arch,
-                             ','.join(build_config['BUILD_VARIANTS'][target_arch]['VARIANTS'])))
-    exit(-1)
-
-tools_variant = build_config['BUILD_VARIANTS'][host_arch]['DEFAULT_VARIANT']
-
-package_graphs = build_config['BUILD_VARIANTS'][target_arch]['VARIANTS'][build_variant]['GRAPHS']
-sorted_packages = sort_package_list(package_graphs)
-if host_arch in build_config['BUILD_VARIANTS']:
-    tools_graphs = build_config['BUILD_VARIANTS'][host_arch]['VARIANTS'][tools_variant]['GRAPHS']
-else:
-    tools_graphs = None
-
-if args.plot:
-    bcc.draw_graphic(package_graphs)
-    exit(0)
-
-# -l without -a
-if args.list and not args.dep:
-    show_info()
-    print('=========================Packages===============================')
-    print('| %-16s| %-20s| %s'%('Package Name', 'Description', 'Source Dir'))
-    for pkg in sorted_packages:
-        pkg_cfg = build_config['PACKAGES'][target_arch].get(pkg, None)
-        path = ''
-        if pkg_cfg:
-            label = pkg_cfg.get('Label', '')
-            path = os.path.normpath(os.path.join(build_config['proj_root'], pkg_cfg['Path']))
-        else:
-            label = 'Stand for All Packages'
-
-        print('| %-16s| %-20s| %s'%(pkg, label, path))
-    exit(0)
-
-arg_package_list = []
-if args.packages:
-    arg_package_list = args.packages.split(',')
-else:
-    arg_package_list += bcc.guess_current_package(os.getcwd(), build_config, target_arch)
-
-for pkg in arg_package_list:
-    if not pkg in sorted_packages:
-        if args.packages:
-            print('==== Invalid package %s for %s! Please select packages from the following: ===='%(pkg, target_arch))
+def do_print(line):
+    # build output comes in blocks of whole lines, as bytes
+    sys.stdout.flush()
+    if hasattr(sys.stdout, 'buffer'):
+        sys.stdout.buffer.write(line)
+        sys.stdout.buffer.flush()
+    else:
+        sys.stdout.write(line)
+
+def main(argv):
+    def show_info(target_arch, build_variant):
+        print('================================================================')
+        print('            Build Central version 1.0.1')
+        print('Supported architectures: ' + ', '.join(build_config['TARGET_LIST']))
+        print('     Supported variants: ' + ','.join(build_config['BUILD_VARIANTS'][target_arch]['VARIANTS']))
+        print('  Building architecture: ' + target_arch)
+        print('       Building variant: ' + build_variant)
+        print('             Stage path: ' + os.path.normpath(bcc.get_stage_path(build_config, target_arch, build_variant)))
+        print('            Output path: ' + os.path.normpath(build_config['OUTPUT_DIR']))
+        print('================================================================')
+
+    args = parser.parse_args(argv)
+
+    if args.cmake_generator and not args.cmake_generator in bcc.cmake_generator:
+        print('Generator %s is not supported!'%(args.cmake_generator))
+        show_generator()
+        return -1
+
+    load_start = time.time()
+    build_config = bcc.load_build_config(None, None)
+    plan_start = time.time()
+    bcc.add_trace_event('load config', 'config', load_start, plan_start)
+    if build_config['ret'] != 'ok':
+        print(build_config['ret'])
+        return -1
+
+    if args.extra_make_var:
+        build_config['extra_make_var'] = args.extra_make_var.split(',')
+    build_config['force_build'] = args.force
+    build_config['refresh_env'] = args.refresh_env
+    build_config['artifact_cache'] = not args.no_cache
+    build_config['quiet'] = args.quiet
+    build_config['tail'] = args.tail
+    if args.workers:
+        build_config['workers'] = args.workers.split(',')
+
+    # -t and -r take several arches and variants separated by ',': all of
+    # them are built in one schedule
+    host_arch = build_config['os_type']
+    build_matrix = []
+    for target_arch in (args.target_arch or build_config['DEFAULT_TARGET']).split(','):
+        if target_arch == build_config['HOST']:
+            target_arch = host_arch
+        if not target_arch in build_config['TARGET_LIST']:
+            print('Error: invalid target arch: %s'%(target_arch))
+            return -1
+
+        if not target_arch in build_config['BUILD_VARIANTS']:
+            print('Error: arch %s is not defined in BUILD_VARIANTS tag!'%(target_arch))
+            return -1
+
+        build_variants = [build_config['BUILD_VARIANTS'][target_arch]['DEFAULT_VARIANT']]
+        if args.build_variant:
+            build_variants = args.build_variant.split(',')
+        for build_variant in build_variants:
+            if not build_variant in build_config['BUILD_VARIANTS'][target_arch]['VARIANTS']:
+                print('Error: variant %s is invalid!'%(build_variant))
+                print('Available variant for arch %s: %s'%(target_arch,
+                                         ','.join(build_config['BUILD_VARIANTS'][target_arch]['VARIANTS'])))
+                return -1
+            if not (target_arch, build_variant) in build_matrix:
+                build_matrix.append((target_arch, build_variant))
+
+    if len(build_matrix) > 1 and (args.plot or args.list or args.info or args.watch):
+        print('Error! -p, -l, -i and --watch can not be used with several arches or variants!')
+        return -1
+
+    tools_variant = build_config['BUILD_VARIANTS'][host_arch]['DEFAULT_VARIANT']
+    if host_arch in build_config['BUILD_VARIANTS']:
+        tools_graph = build_config['BUILD_VARIANTS'][host_arch]['VARIANTS'][tools_variant]['GRAPH']
+    else:
+        tools_graph = None
+
+    changed_files = None
+    if args.affected:
+        if args.packages or args.exclusive:
+            print('Error! --affected can not be used together with packages or -e!')
+            return -1
+        changed_files = bcc.get_changed_files(args.affected, os.getcwd())
+        if changed_files['ret'] != 'ok':
+            print(changed_files['ret'])
+            return -1
+
+    def plan_build(target_arch, build_variant):
+        # the packages to build for one arch and variant, or the exit code
+        # when nothing is to be built
+        package_graphs = build_config['BUILD_VARIANTS'][target_arch]['VARIANTS'][build_variant]['GRAPHS']
+        package_graph = build_config['BUILD_VARIANTS'][target_arch]['VARIANTS'][build_variant]['GRAPH']
+        sorted_packages = sort_package_list([package_graph])
+
+        if args.plot:
+            bcc.draw_graphic(package_graphs)
+            return 0
+
+        # -l without -a
+        if args.list and not args.dep:
+            show_info(target_arch, build_variant)
+            print('=========================Packages===============================')
+            print('| %-16s| %-20s| %s'%('Package Name', 'Description', 'Source Dir'))
             for pkg in sorted_packages:
+                pkg_cfg = build_config['PACKAGES'][target_arch].get(pkg, None)
+                path = ''
+                if pkg_cfg:
+                    label = pkg_cfg.get('Label', '')
+                    path = os.path.normpath(os.path.join(build_config['proj_root'], pkg_cfg['Path']))
+                else:
+                    label = 'Stand for All Packages'
+
+                print('| %-16s| %-20s| %s'%(pkg, label, path))
+            return 0
+
+        arg_package_list = []
+        if changed_files:
+            affected = bcc.get_affected_packages(changed_files['files'], build_config, target_arch, package_graph)
+            print('==== %d files changed in packages: %s'%(len(changed_files['files']), ' '.join(affected['changed'])))
+            arg_package_list = affected['affected']
+        elif args.packages:
+            arg_package_list = args.packages.split(',')
+        else:
+            arg_package_list += bcc.guess_current_package(os.getcwd(), build_config, target_arch)
+
+        # --affected can give thousands of packages: look them up in a set
+        known_packages = set(sorted_packages)
+        for pkg in arg_package_list:
+            if not pkg in known_packages:
+                if args.packages:
+                    print('==== Invalid package %s for %s! Please select packages from the following: ===='%(pkg, target_arch))
+                    for pkg in sorted_packages:
+                        print(pkg)
+                    return -1
+                else:
+                    print('==== Work directory matches package %s but not configured in building list. Skipping...'%(pkg))
+                    arg_package_list.remove(pkg)
+
+        package_list = []
+        if args.exclusive:
+            if arg_package_list:
+                if bcc.build_all_target in arg_package_list:
+                    print('Error! -e option should specify package %s!'%(bcc.build_all_target))
+                    return -1
+                for pkg in ordered_packages:
+                    if not pkg in arg_package_list and pkg != bcc.build_all_target:
+                        package_list.append(pkg)
+            else:
+                print('Error! -e option should specify a package to build!')
+                return -1
+        else:
+            if arg_package_list:
+                package_list = arg_package_list
+        package_list = list(set(package_list))
+
+        with_dep = args.dep
+        if len(package_list) == 1 and package_list[0] == bcc.build_all_target:
+            with_dep = True
+
+        # -la
+        if args.list and with_dep:
+            show_info(target_arch, build_variant)
+            for pkg in package_list:
                 print(pkg)
-            exit(-1)
+                dep_list = bcc.get_build_order(package_graph, [pkg])
+
+                tools = []
+                tools_dep_list = []
+                if tools_graph:
+                    tools = bcc.get_tools(build_config, target_arch, dep_list)
+                    tools_dep_list = bcc.get_build_order(tools_graph, tools)
+
+                if target_arch == host_arch:
+                    dep_list = [pkg for pkg in dep_list if not pkg in tools_dep_list]
+
+                for tool in tools_dep_list:
+                    print('    ' + tool + '(host)')
+                for pkg in dep_list:
+                    print('    ' + pkg)
+            return 0
+
+        dep_list = bcc.get_build_order(package_graph, package_list)
+        if with_dep:
+            package_build_list = dep_list
         else:
-            print('==== Work directory matches package %s but not configured in building list. Skipping...'%(pkg))
-            arg_package_list.remove(pkg)
-
-package_list = []
-if args.exclusive:
-    if arg_package_list:
-        if bcc.build_all_target in arg_package_list:
-            print('Error! -e option should specify package %s!'%(bcc.build_all_target))
-            exit(-1)
-        for pkg in ordered_packages:
-            if not pkg in arg_package_list and pkg != bcc.build_all_target:
-                package_list.append(pkg)
+            package_set = set(package_list)
+            package_build_list = [pkg for pkg in dep_list if pkg in package_set]
+
+        tools = set()
+        if with_dep and tools_graph:
+            tools = bcc.get_tools(build_config, target_arch, package_build_list)
+
+        if args.info:
+            retry_list = []
+            for pkg in package_build_list:
+                installed = bcc.get_install_list(target_arch, pkg, build_config, build_variant)
+                if installed['info'] == 'retry':
+                    retry_list.append(pkg)
+                elif installed['info'] == 'ok':
+                    print('> ' + pkg)
+                    for i in installed['files']:
+                        print(i)
+            if len(retry_list):
+                print('==== Warning! Please build the following packages before installing list is available. ====')
+                for pkg in retry_list:
+                    print('  ' + pkg)
+
+            show_info(target_arch, build_variant)
+            show_generator()
+            return 0
+
+        return {'arch' : target_arch, 'variant' : build_variant, 'graph' : package_graph,
+                'package_list' : package_list, 'dep_list' : dep_list,
+                'package_build_list' : package_build_list, 'tools' : tools}
+
+    plans = []
+    for target_arch, build_variant in build_matrix:
+        plan = plan_build(target_arch, build_variant)
+        if not isinstance(plan, dict):
+            return plan
+        plans.append(plan)
+    if changed_files and not [plan for plan in plans if plan['package_list']]:
+        print('==== No package is affected. Nothing to build.')
+        return 0
+
+    # host tools are built once for all arches and variants
+    tools_build_list = []
+    if tools_graph:
+        tools_build_list = bcc.get_build_order(tools_graph, set().union(*[plan['tools'] for plan in plans]))
+    # other host variants build them again: their packages depend on that variant
+    for plan in plans:
+        if plan['arch'] == host_arch and plan['variant'] == tools_variant:
+            plan['package_build_list'] = [pkg for pkg in plan['package_build_list'] if not pkg in tools_build_list]
+
+    if args.export_ninja:
+        builds = []
+        if tools_build_list:
+            builds.append((host_arch, tools_variant, tools_build_list))
+        for plan in plans:
+            builds.append((plan['arch'], plan['variant'], plan['package_build_list']))
+        # the file is exported again with the same arguments when the config changes
+        regen_cmd = [sys.executable, os.path.abspath(__file__), '--no-daemon'] + list(argv)
+        ret = bcc.export_ninja(args.export_ninja, builds, args.debug, args.verbose, args.jobs,
+                               args.parallel, args.cmake_generator, build_config, regen_cmd, os.getcwd())
+        if ret['ret'] != 'ok':
+            print(ret['ret'])
+            return -1
+        print('==== %d steps of %d packages written to %s'%(ret['steps'], sum([len(build[2]) for build in builds]),
+                                                           args.export_ninja))
+        return 0
+
+    not_build = False
+    if args.clean and not args.clean_build:
+        not_build = True
+
+    clean_type = None
+    if args.clean:
+        clean_type = 'uninstall_clean'
+
+    bcc.add_trace_event('plan', 'plan', plan_start, time.time(),
+                        {'packages' : len(tools_build_list) + sum([len(plan['package_build_list']) for plan in plans])})
+    def build_packages(plans, tools_build_list, clean_type, not_build):
+        builds = []
+        build_list = []
+        if tools_build_list:
+            builds.append((host_arch, tools_variant, tools_build_list))
+            build_list += [((host_arch, tools_variant, tool), tool + '(host)') for tool in tools_build_list]
+        for plan in plans:
+            builds.append((plan['arch'], plan['variant'], plan['package_build_list']))
+            for pkg in plan['package_build_list']:
+                name = pkg
+                if len(plans) > 1:
+                    name = '%s/%s/%s'%(plan['arch'], plan['variant'], pkg)
+                build_list.append(((plan['arch'], plan['variant'], pkg), name))
+        ret = bcc.do_build_matrix(builds,
+                                  args.debug,
+                                  args.verbose,
+                                  clean_type,
+                                  not_build,
+                                  args.jobs,
+                                  args.cmake_generator,
+                                  build_config,
+                                  do_print,
+                                  args.parallel)
+        build_status = ret['status']
+        cache_stats = ret.get('compiler_cache', {})
+
+        print('')
+        for plan in plans:
+            show_info(plan['arch'], plan['variant'])
+        print('==== The following packages are specified: ====')
+        for plan in plans:
+            for pkg in plan['package_list']:
+                if len(plans) > 1:
+                    print('  %s/%s/%s'%(plan['arch'], plan['variant'], pkg))
+                else:
+                    print('  ' + pkg)
+
+        print('\n==== Build status: ====')
+        status_symbol = {'done' : '>', 'skip' : '>', 'cached' : '>', 'fail' : '?'}
+        for job, pkg in build_list:
+            if ret['info'] != 'ok' and ret['package'] == job:
+                cur_symbol = '?'
+            else:
+                cur_symbol = status_symbol.get(build_status.get(job), ' ')
+            if build_status.get(job) == 'skip':
+                print(cur_symbol + ' ' + pkg + ' (up to date, skipped)')
+            elif build_status.get(job) == 'cached':
+                print(cur_symbol + ' ' + pkg + ' (restored from cache)')
+            elif job in cache_stats:
+                print(cur_symbol + ' ' + pkg + ' (ccache: %d hits, %d misses)'%(cache_stats[job]['hits'], cache_stats[job]['misses']))
+            else:
+                print(cur_symbol + ' ' + pkg)
+        if cache_stats:
+            hits = sum([stats['hits'] for stats in cache_stats.values()])
+            misses = sum([stats['misses'] for stats in cache_stats.values()])
+            if hits + misses:
+                print('==== ccache: %d hits, %d misses (%d%%) ===='%(hits, misses, hits * 100 // (hits + misses)))
+
+        if ret['info'] == 'ok':
+            print('==== Success! ====')
+        else:
+            print('==== Failure! ====')
+            print('\n' + ret['info'])
+
+        log_dir = build_config['LOG_DIR']
+        if len(plans) == 1:
+            log_dir = os.path.join(log_dir, plans[0]['arch'], plans[0]['variant'])
+        if ret.get('log'):
+            print('\nLog file: ' + ret['log'])
+        else:
+            print('\nLog dir: ' + log_dir)
+        trace_file = os.path.join(log_dir, 'trace.json')
+        if bcc.write_trace(trace_file):
+            print('Trace file: ' + trace_file)
+        print('Output dir: ' + build_config['OUTPUT_DIR'] + '\n')
+        return ret
+
+    ret = build_packages(plans, tools_build_list, clean_type, not_build)
+
+    if args.watch and ret['info'] != 'break' and not not_build:
+        # The config, the environments and the build trees are kept; only the
+        # packages owning changed files and the packages depending on them are
+        # built again, without cleaning. Files changed while building are
+        # handled by the next round: an in-tree package whose build wrote them
+        # is up to date by then and skipped.
+        plan = plans[0]
+        target_arch = plan['arch']
+        watch_list = plan['dep_list']
+        watch_paths = [os.path.normpath(os.path.join(build_config['proj_root'], build_config['PACKAGES'][target_arch][pkg]['Path']))
+                       for pkg in watch_list]
+        watcher = bcc.create_file_watcher(watch_paths, set([build_config['OUTPUT_DIR']]))
+        print('==== Watching %d packages%s. Press Ctrl-C to stop.'%(len(watch_list),
+              watcher['fd'] is None and ' (polling)' or ''))
+        try:
+            while True:
+                changed_files = bcc.wait_file_changes(watcher)
+                affected = bcc.get_affected_packages(changed_files, build_config, target_arch, plan['graph'])
+                affected_set = set(affected['affected'])
+                rebuild_list = [pkg for pkg in watch_list if pkg in affected_set]
+                if not rebuild_list:
+                    continue
+                print('==== %d files changed in packages: %s'%(len(changed_files), ' '.join(affected['changed'])))
+                ret = build_packages([dict(plan, package_list = rebuild_list, package_build_list = rebuild_list)], [], None, False)
+                if ret['info'] == 'break':
+                    break
+                print('==== Watching %d packages. Press Ctrl-C to stop.'%(len(watch_list)))
+        except KeyboardInterrupt:
+            pass
+        bcc.close_file_watcher(watcher)
+
+    if ret['info'] == 'ok':
+        return 0
     else:
-        print('Error! -e option should specify a package to build!')
-        exit(-1)
-else:
-    if arg_package_list:
-        package_list = arg_package_list
-package_list = list(set(package_list))
-
-if len(package_list) == 1 and package_list[0] == bcc.build_all_target:
-    args.dep = True
-
-# -la
-if args.list and args.dep:
-    show_info()
-    for pkg in package_list:
-        print(pkg)
-        dep_list = []
-        bcc.generate_build_order(package_graphs, pkg, dep_list)
-        dep_list.reverse()
-
-        tools = []
-        if tools_graphs:
-            tools = bcc.get_tools(build_config, target_arch, dep_list)
-            tools_dep_list = []
-            for tool in tools:
-                bcc.generate_build_order(tools_graphs, tool, tools_dep_list)
-            tools_dep_list.reverse()
-
-        if target_arch == host_arch:
-            dep_list = [pkg for pkg in dep_list if not pkg in tools_dep_list]
-
-        for tool in tools_dep_list:
-            print('    ' + tool + '(host)')
-        for pkg in dep_list:
-            print('    ' + pkg)
-    exit(0)
-
-dep_list = []
-for pkg in package_list:
-    bcc.generate_build_order(package_graphs, pkg, dep_list)
-dep_list.reverse()
-if args.dep:
-    package_build_list = dep_list
-else:
-    package_build_list = [pkg for pkg in dep_list if pkg in package_list]
-
-tools_build_list = []
-if args.dep:
-    if tools_graphs:
-        tools = bcc.get_tools(build_config, target_arch, package_build_list)
-        for tool in tools:
-            bcc.generate_build_order(tools_graphs, tool, tools_build_list)
-        tools_build_list.reverse()
-
-if args.info:
-    retry_list = []
-    for pkg in package_build_list:
-        installed = bcc.get_install_list(target_arch, pkg, build_config, build_variant)
-        if installed['info'] == 'retry':
-            retry_list.append(pkg)
-        elif installed['info'] == 'ok':
-            print('> ' + pkg)
-            for i in installed['files']:
-                print(i)
-    if len(retry_list):
-        print('==== Warning! Please build the following packages before installing list is available. ====')
-        for pkg in retry_list:
-            print('  ' + pkg)
-
-    show_info()
-    show_generator()
-    exit(0)
-
-def do_print(line):
-    print(line),
-
-not_build = False
-if args.clean and not args.clean_build:
-    not_build = True
-
-clean_type = None
-if args.clean:
-    clean_type = 'uninstall_clean'
-
-ret = None
-failure_package = ''
-if tools_build_list:
-    ret = bcc.do_build_packages(tools_build_list,
-                               host_arch,
-                               tools_variant,
-                               args.debug,
-                               args.verbose,
-                               clean_type,
-                               not_build,
-                               args.jobs,
-                               args.cmake_generator,
-                               build_config,
-                               do_print)
-    if ret['info'] != 'ok':
-        failure_package = ret['package'] + '(host)'
-
-if target_arch == host_arch:
-    package_build_list = [pkg for pkg in package_build_list if not pkg in tools_build_list]
-
-if ret is None or ret['info'] == 'ok':
-    ret = bcc.do_build_packages(package_build_list,
-                               target_arch,
-                               build_variant,
-                               args.debug,
-                               args.verbose,
-                               clean_type,
-                               not_build,
-                               args.jobs,
-                               args.cmake_generator,
-                               build_config,
-                               do_print)
-    if ret['info'] != 'ok':
-        failure_package = ret['package']
-
-print('')
-show_info()
-print('==== The following packages are specified: ====')
-for pkg in package_list:
-    print('  ' + pkg)
-
-print('\n==== Build status: ====')
-build_list = [pkg + '(host)' for pkg in tools_build_list] + package_build_list
-cur_symbol = '>'
-for pkg in build_list:
-    if ret['info'] != 'ok' and failure_package == pkg:
-        cur_symbol = '?'
-    print(cur_symbol + ' ' + pkg)
-    if cur_symbol == '?':
-        cur_symbol = ' '
-
-if ret['info'] == 'ok':
-    print('==== Success! ====')
-else:
-    print('==== Failure! ====')
-    print('\n' + ret['info'])
-
-print('\nLog file: ' + os.path.join(build_config['LOG_DIR'], target_arch, 'log'))
-print('Output dir: ' + build_config['OUTPUT_DIR'] + '\n')
-
-if ret['info'] == 'ok':
-    exit(0)
-else:
-    exit(-1)
+        return -1
+
+if __name__ == '__main__':
+    code = None
+    # a running bc_daemon.py already has the config and the environments;
+    # --watch keeps running and stays in this process
+    if not '--no-daemon' in sys.argv and not '--watch' in sys.argv:
+        code = bcc.run_daemon_client(sys.argv[1:])
+    if code is None:
+        code = main(sys.argv[1:])
+    exit(code)
@@ -7,12 +7,17 @@ import os
 import sys
 import subprocess as sp
 
+def is_project_root(path):
+    for name in ['external', 'workspace', 'project', 'tools']:
+        if not os.path.isdir(os.path.join(path, name)):
+            return False
+    return True
+
 def guess_project_root():
-    signature = set(['external', 'workspace', 'project', 'tools'])
     cur_dir = os.getcwd()
     parent_dir = os.path.abspath(os.path.join(cur_dir, os.pardir))
     while (parent_dir != cur_dir):
-        if signature.issubset(set(os.listdir(cur_dir))):
+        if is_project_root(cur_dir):
             break
         cur_dir = parent_dir
         parent_dir = os.path.abspath(os.path.join(cur_dir, os.pardir))
@@ -23,6 +28,7 @@ def guess_project_root():
 
 project_root = guess_project_root()
 if (project_root):
+    os.environ['BC_PROJECT_ROOT'] = project_root
     bc = os.path.join(project_root, 'tools', 'buildCentral')
     if sys.argv[0][-7:] == 'gmk.cmd':
         bc = os.path.join(bc, 'gbuild_central.py')